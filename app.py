@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
-from flask import Flask, render_template, request, jsonify, send_from_directory, Response, stream_with_context, send_file
+from flask import Flask, Request, render_template, request, jsonify, send_from_directory, Response, stream_with_context, send_file, abort
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.routing import BaseConverter
+from werkzeug.security import safe_join
 import os
-import json
+import errno
+import shutil
+import orjson
 from pathlib import Path
 import time
 import queue
@@ -12,7 +17,31 @@ import re
 import cv2
 import numpy as np
 from io import BytesIO
+from urllib.parse import unquote
 import base64
+import gzip
+import hashlib
+import mimetypes
+import mmap
+import tempfile
+import threading
+import atexit
+import logging
+import logging.handlers
+from datetime import datetime
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+# Log records from request handlers are queued and written by a listener thread, so a
+# slow terminal or pipe never holds up a request
+log = logging.getLogger('octowatch')
+log.setLevel(logging.INFO)
+log.propagate = False
+_log_queue = queue.SimpleQueue()
+log.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler(sys.stdout))
+_log_listener.start()
+atexit.register(_log_listener.stop)
 
 # Store mapping of MVI codes to original uploaded filenames
 VIDEO_UPLOAD_MAPPING = {}
@@ -23,22 +52,343 @@ def load_upload_mapping():
     global VIDEO_UPLOAD_MAPPING
     if MAPPING_FILE.exists():
         try:
-            with open(MAPPING_FILE, 'r') as f:
-                VIDEO_UPLOAD_MAPPING = json.load(f)
+            VIDEO_UPLOAD_MAPPING = orjson.loads(MAPPING_FILE.read_bytes())
         except Exception as e:
             print(f"Error loading upload mapping: {e}")
             VIDEO_UPLOAD_MAPPING = {}
     else:
         VIDEO_UPLOAD_MAPPING = {}
 
+# Saves are debounced: save_upload_mapping() only marks the mapping dirty and a
+# background thread writes it out every few seconds (and once more at exit)
+_MAPPING_LOCK = threading.Lock()
+_MAPPING_FLUSH_INTERVAL = 2.0
+_mapping_dirty = False
+# Bumped on every change, so responses built from the mapping know when they're stale
+_mapping_version = 0
+
 def save_upload_mapping():
-    """Save the upload mapping to persistent storage"""
+    """Schedule the upload mapping to be saved to persistent storage"""
+    global _mapping_dirty, _mapping_version
+    with _MAPPING_LOCK:
+        _mapping_dirty = True
+        _mapping_version += 1
+
+def flush_upload_mapping():
+    """Write the upload mapping to disk if it changed, atomically via a temp file"""
+    global _mapping_dirty
+    with _MAPPING_LOCK:
+        if not _mapping_dirty:
+            return
+        _mapping_dirty = False
+        try:
+            MAPPING_FILE.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = MAPPING_FILE.with_suffix('.json.tmp')
+            write_file(tmp_path, orjson.dumps(VIDEO_UPLOAD_MAPPING, option=orjson.OPT_INDENT_2))
+            os.replace(tmp_path, MAPPING_FILE)
+        except Exception as e:
+            print(f"Error saving upload mapping: {e}")
+
+def _flush_upload_mapping_loop():
+    while True:
+        time.sleep(_MAPPING_FLUSH_INTERVAL)
+        flush_upload_mapping()
+
+# Index of the videos/ and videos_keyframes/ directories, rebuilt only when either
+# directory's mtime changes: (mtimes, {code: video_path}, {codes with keyframes}, next free code,
+# {code: video_url})
+_MEDIA_INDEX = (None, {}, frozenset(), 1, {})
+# Directory mtimes newer than this are not trusted, since filesystems with coarse
+# timestamps can hide a second change made within the same tick
+_MEDIA_INDEX_SETTLE_NS = 2_000_000_000
+# Names the index picks up: MVI_XXXX_proxy.mp4 (or .MP4) and MVI_XXXX_keyframes.json
+_MVI_VIDEO_RE = re.compile(r'MVI_([0-9]{4})_proxy\.(?:mp4|MP4)')
+_MVI_KEYFRAMES_RE = re.compile(r'MVI_([0-9]{4})_keyframes\.json')
+# A 4-digit code anywhere in an uploaded filename, e.g. 'trial_0042.mp4'
+_FILENAME_CODE_RE = re.compile(r'(?:^|\D)(\d{4})(?:\D|$)')
+
+def media_index():
+    """Return the whole _MEDIA_INDEX tuple, rebuilding it first if either directory changed.
+
+    Callers that need more than one of its fields should read them all from the tuple
+    returned here, since another request can swap in a rebuilt index at any time.
+    """
+    global _MEDIA_INDEX
+    mtimes = (os.stat('videos').st_mtime_ns, os.stat('videos_keyframes').st_mtime_ns)
+    index = _MEDIA_INDEX
+    if mtimes == index[0] and time.time_ns() - max(mtimes) > _MEDIA_INDEX_SETTLE_NS:
+        return index
+    
+    videos = {}
+    video_urls = {}
+    with os.scandir('videos') as entries:
+        for entry in entries:
+            match = _MVI_VIDEO_RE.fullmatch(entry.name)  # MVI_XXXX_proxy.mp4 -> XXXX
+            if match:
+                code = match.group(1)
+                videos[code] = Path('videos') / entry.name
+                # Versioned by mtime so the URL can be cached as immutable; a code that
+                # is deleted and uploaded again gets a new URL
+                video_urls[code] = f'/videos/{entry.name}?v={entry.stat().st_mtime_ns}'
+    
+    codes = set()
+    with os.scandir('videos_keyframes') as entries:
+        for entry in entries:
+            match = _MVI_KEYFRAMES_RE.fullmatch(entry.name)  # MVI_XXXX_keyframes.json -> XXXX
+            if match:
+                codes.add(match.group(1))
+    keyframe_codes = frozenset(codes)
+    
+    # Lowest unused code, so uploads don't have to probe for one each time; 10000 if all are taken
+    taken = np.zeros(10001, dtype=bool)
+    taken[[int(code) for code in videos]] = True
+    taken[0] = True  # codes start at 0001
+    next_free_code = int(np.argmin(taken)) if not taken.all() else 10000
+    
+    index = (mtimes, videos, keyframe_codes, next_free_code, video_urls)
+    _MEDIA_INDEX = index
+    return index
+
+def get_media_index():
+    """Return ({code: video_path}, frozenset of codes with keyframes) without per-request globbing"""
+    _, videos, keyframe_codes, _, _ = media_index()
+    return videos, keyframe_codes
+
+def invalidate_media_index():
+    """Force a rebuild on next access, for keyframes rewritten in place"""
+    global _MEDIA_INDEX
+    _MEDIA_INDEX = (None,) + _MEDIA_INDEX[1:]
+
+# Codes handed to uploads that are still being written, guarded by _ALLOC_LOCK
+_ALLOC_LOCK = threading.Lock()
+_RESERVED_CODES = set()
+
+def reserve_code(preferred=None):
+    """Reserve an unused MVI code as an int: preferred if it's free, else the lowest free one.
+
+    Returns None once all 9999 are taken. Concurrent uploads can't be handed the same
+    code; call release_code() once the video is in videos/ (or the upload failed).
+    """
+    with _ALLOC_LOCK:
+        _, videos, _, next_free_code, _ = media_index()
+        
+        def is_free(code):
+            return f'{code:04d}' not in videos and code not in _RESERVED_CODES
+        
+        if preferred is not None and 1 <= preferred <= 9999 and is_free(preferred):
+            code = preferred
+        else:
+            code = next_free_code  # lowest code without a video
+            while code <= 9999 and not is_free(code):
+                code += 1
+            if code > 9999:
+                return None
+        _RESERVED_CODES.add(code)
+        return code
+
+def release_code(code):
+    """Drop a reservation made by reserve_code()"""
+    with _ALLOC_LOCK:
+        _RESERVED_CODES.discard(code)
+
+# (_MEDIA_INDEX it was built from, serialized /list-available-codes body)
+_CODES_RESPONSE = (None, b'')
+
+def get_codes_response():
+    """Serialized /list-available-codes body, rebuilt only when the media index changes"""
+    global _CODES_RESPONSE
+    index = media_index()
+    _, video_files, keyframe_codes, _, _ = index
+    if _CODES_RESPONSE[0] is index:
+        return _CODES_RESPONSE[1]
+    
+    # Check existing keyframes for experiment type flags. Files that changed since the
+    # last rebuild have to be read, so overlap those reads instead of paying each
+    # file's open/seek latency in turn
+    keyframes_dir = Path('videos_keyframes')
+    codes = sorted(video_files)
+    with_keyframes = [code for code in codes if code in keyframe_codes]
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        experiment_types = dict(zip(with_keyframes, pool.map(
+            get_experiment_type,
+            [keyframes_dir / f'MVI_{code}_keyframes.json' for code in with_keyframes]
+        )))
+    
+    codes_info = []
+    for code in codes:
+        codes_info.append({
+            'code': code,
+            'has_video': True,
+            'has_keyframes': code in keyframe_codes,
+            'experiment_type': experiment_types.get(code)
+        })
+    
+    body = orjson.dumps({'codes': codes_info})
+    _CODES_RESPONSE = (index, body)
+    return body
+
+_COPY_BUFSIZE = 1024 * 1024
+
+def copy_file(src, dst):
+    """Copy a file and its metadata, letting the kernel move the bytes where it can"""
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        infd, outfd = fsrc.fileno(), fdst.fileno()
+        size = os.fstat(infd).st_size
+        copied = 0
+        # copy_file_range can reflink on btrfs/xfs; sendfile covers older kernels.
+        # Either may be unsupported for this pair of files, which only shows up on the first call
+        for kernel_copy in (
+            lambda n: os.copy_file_range(infd, outfd, n, copied),
+            lambda n: os.sendfile(outfd, infd, copied, n),
+        ):
+            try:
+                while copied < size:
+                    sent = kernel_copy(size - copied)
+                    if sent == 0:
+                        break
+                    copied += sent
+                break
+            except (AttributeError, OSError) as e:
+                if copied or (isinstance(e, OSError) and e.errno == errno.ENOSPC):
+                    raise
+
+        # Plain read/write for whatever the kernel paths couldn't handle
+        if copied < size:
+            fsrc.seek(copied)
+            fdst.seek(copied)
+            buf = bytearray(_COPY_BUFSIZE)
+            view = memoryview(buf)
+            while n := fsrc.readinto(buf):
+                fdst.write(view[:n])
+    shutil.copystat(src, dst)
+
+def link_or_copy_file(src, dst):
+    """Make dst a hard link to src, or a copy where linking isn't possible, replacing any existing dst.
+
+    Only safe for files that are replaced rather than rewritten in place afterwards,
+    which holds for everything in videos_keyframes/.
+    """
+    tmp = f'{dst}.tmp'
+    Path(tmp).unlink(missing_ok=True)
     try:
-        MAPPING_FILE.parent.mkdir(parents=True, exist_ok=True)
-        with open(MAPPING_FILE, 'w') as f:
-            json.dump(VIDEO_UPLOAD_MAPPING, f, indent=2)
-    except Exception as e:
-        print(f"Error saving upload mapping: {e}")
+        os.link(src, tmp)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        copy_file(src, tmp)  # e.g. a filesystem without hard links
+    os.replace(tmp, dst)
+
+def write_file(path, data):
+    """Write bytes to a new or truncated file with plain os.write calls, synced to disk before returning"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        # Callers rename the file into place next; without the sync a crash could
+        # leave the renamed file empty
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def keyframes_backup_path(code):
+    """Path for a new timestamped backup of a code's keyframes file"""
+    # Local time to the second, as before, plus the nanoseconds so two backups made
+    # within the same second don't overwrite each other
+    now_ns = time.time_ns()
+    t = time.localtime(now_ns // 1_000_000_000)
+    stamp = '%04d%02d%02d_%02d%02d%02d_%09d' % (
+        t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec, now_ns % 1_000_000_000
+    )
+    return Path(f'videos_keyframes/MVI_{code}_keyframes.backup_{stamp}.json')
+
+def read_json_file(path):
+    """Parse a JSON file straight from a read-only memory map, without copying it into a bytes object"""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return orjson.loads(b'')  # mmap can't map an empty file; raises JSONDecodeError
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            return orjson.loads(view)
+
+def read_detection_params(path):
+    """Return a keyframes file's detection_params, or None, decoding only the file header when possible"""
+    # The detector writes detection_params (a flat object) ahead of the per-frame
+    # keyframes, and edits keep that key order, so it sits in the first few hundred bytes
+    with open(path, 'rb') as f:
+        head = f.read(64 * 1024)
+    keyframes_at = head.find(b'"keyframes"')
+    params_at = head.find(b'"detection_params"', 0, keyframes_at if keyframes_at != -1 else len(head))
+    if params_at != -1:
+        start = head.find(b'{', params_at)
+        end = head.find(b'}', start)
+        if start != -1 and end != -1 and (keyframes_at == -1 or end < keyframes_at):
+            try:
+                return orjson.loads(head[start:end + 1])
+            except orjson.JSONDecodeError:
+                pass  # not a flat object after all
+    
+    # Unusual layout (e.g. an imported file with other key order): parse the whole file
+    keyframes_data = read_json_file(path)
+    return keyframes_data.get('detection_params') if isinstance(keyframes_data, dict) else None
+
+@lru_cache(maxsize=4096)
+def _experiment_type_for(path_str, mtime_ns, size):
+    """Experiment type recorded in a keyframes file, memoized on (path, mtime, size)"""
+    params = read_detection_params(path_str)
+    # Check if detection_params has experiment type flags
+    if params:
+        if params.get('is_mirror', False):
+            return 'mirror'
+        elif params.get('is_social', False):
+            return 'social'
+        elif params.get('is_control', False):
+            return 'control'
+    return None
+
+def get_experiment_type(keyframes_path):
+    """Return 'mirror', 'social', 'control' or None for a keyframes file"""
+    try:
+        st = os.stat(keyframes_path)
+        return _experiment_type_for(str(keyframes_path), st.st_mtime_ns, st.st_size)
+    except (orjson.JSONDecodeError, IOError):
+        # If we can't read the file, default to None
+        return None
+
+@lru_cache(maxsize=64)
+def _encode_keyframes(path_str, mtime_ns, size):
+    """Serialized keyframes, memoized on (path, mtime, size) so edits invalidate naturally"""
+    return orjson.dumps(read_json_file(path_str))
+
+def _load_response_chunks(path_str, mtime_ns, size, video_url):
+    """/load-by-code body as a sequence of chunks around the cached keyframes bytes"""
+    return [
+        b'{"video_url":', orjson.dumps(video_url),
+        b',"keyframes":', _encode_keyframes(path_str, mtime_ns, size),
+        b'}'
+    ]
+
+@lru_cache(maxsize=64)
+def _gzip_load_response(path_str, mtime_ns, size, video_url):
+    """Gzip-compressed /load-by-code body; the repeated per-frame keys compress very well"""
+    return gzip.compress(b''.join(_load_response_chunks(path_str, mtime_ns, size, video_url)), compresslevel=6)
+
+# {keyframes path: frame keys in frame order}. Edits never add or remove frames, so the
+# order of a file's last key set can be reused instead of sorting every request
+_FRAME_ORDER = {}
+
+def sorted_keyframes(path_str, frames):
+    """(frame_key, frame_data) pairs of a keyframes dict, ordered by frame number"""
+    order = _FRAME_ORDER.get(path_str)
+    # Same count and every key present means the same key set, since keys are unique
+    if order is not None and len(order) == len(frames):
+        try:
+            return [(frame_key, frames[frame_key]) for frame_key in order]
+        except KeyError:
+            pass
+    
+    sorted_frames = sorted(frames.items(), key=lambda x: int(x[0]))
+    _FRAME_ORDER[path_str] = [frame_key for frame_key, _ in sorted_frames]
+    return sorted_frames
 
 def calculate_iou(box1, box2):
     """Calculate Intersection over Union between two bounding boxes"""
@@ -66,10 +416,79 @@ def calculate_iou(box1, box2):
     
     return intersection_area / union_area
 
+def interpolate_boxes(prev_values, next_values, timestamps, prev_ts, next_ts):
+    """Linearly interpolate (5,) box rows between two timestamps, one output row per timestamp"""
+    # Computed in place in two buffers rather than through a chain of temporaries
+    weights = np.subtract(timestamps, prev_ts)
+    weights /= next_ts - prev_ts
+    out = np.multiply(weights[:, None], next_values - prev_values)
+    out += prev_values
+    return out
+
+class ORJSONProvider(DefaultJSONProvider):
+    """JSON provider that routes jsonify() and request.get_json() through orjson"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Hand the encoded bytes straight to the response, skipping the str round-trip
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=self.default), mimetype=self.mimetype)
+
+class VideoCodeConverter(BaseConverter):
+    """URL converter matching 4-digit MVI codes, so malformed codes never reach a view"""
+    regex = r'[0-9]{4}'
+
+class UploadRequest(Request):
+    """Request that spools video and keyframes uploads next to their destination, so they can be renamed into place.
+
+    Werkzeug would otherwise spool large file parts to the system temp directory and
+    FileStorage.save() would copy them a second time. Under waitress the body has still
+    been buffered once by the server before it gets here (see __main__). Spool files the
+    view didn't move are removed when the request closes.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.spool_paths = []
+
+    def spool_file(self, directory='videos'):
+        """Open a new temp file in directory that is cleaned up with the request"""
+        os.makedirs(directory, exist_ok=True)
+        f = tempfile.NamedTemporaryFile('wb+', dir=directory, prefix='.upload_', suffix='.part', delete=False)
+        self.spool_paths.append(f.name)
+        os.chmod(f.name, 0o644)  # temp files are private by default; uploads are served as-is
+        return f
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.endpoint == 'upload_video':
+            return self.spool_file()
+        if self.endpoint == 'import_keyframes':
+            return self.spool_file('videos_keyframes')
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+    def close(self):
+        super().close()
+        for path in self.spool_paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
 app = Flask(__name__)
+app.request_class = UploadRequest
+app.json = ORJSONProvider(app)
+app.url_map.converters['code'] = VideoCodeConverter
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 8 * 1024 * 1024 * 1024  # 8GB max file size
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
+# When deployed behind nginx, set this to an internal location prefix (e.g. '/internal')
+# so media files are streamed by nginx via X-Accel-Redirect instead of through Python
+app.config['X_ACCEL_REDIRECT_PREFIX'] = os.environ.get('OCTOWATCH_X_ACCEL_REDIRECT_PREFIX')
 
 # Ensure upload directory exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
@@ -79,6 +498,8 @@ os.makedirs('thumbnails', exist_ok=True)
 
 # Load the upload mapping on startup
 load_upload_mapping()
+threading.Thread(target=_flush_upload_mapping_loop, daemon=True).start()
+atexit.register(flush_upload_mapping)
 
 @app.route('/')
 def index():
@@ -86,132 +507,155 @@ def index():
 
 @app.route('/upload-video', methods=['POST'])
 def upload_video():
-    if 'video' not in request.files:
-        return jsonify({'error': 'Video file is required'}), 400
-    
-    video_file = request.files['video']
-    
-    if video_file.filename == '':
-        return jsonify({'error': 'No file selected'}), 400
+    # Raw uploads send the video as the request body with the filename in a header,
+    # so they can be streamed straight to disk without Werkzeug's multipart parser.
+    # Multipart form uploads are still accepted for older clients.
+    raw_upload = request.mimetype == 'application/octet-stream'
+    if raw_upload:
+        original_filename = unquote(request.headers.get('X-Filename', ''))
+        if original_filename == '':
+            return jsonify({'error': 'No file selected'}), 400
+    else:
+        if 'video' not in request.files:
+            return jsonify({'error': 'Video file is required'}), 400
+        
+        video_file = request.files['video']
+        
+        if video_file.filename == '':
+            return jsonify({'error': 'No file selected'}), 400
+        original_filename = video_file.filename
     
     # Find the next available MVI index
     videos_dir = Path('videos')
     os.makedirs(videos_dir, exist_ok=True)
     
-    # Get all existing MVI codes
-    existing_codes = set()
-    for video_path in videos_dir.glob('MVI_*_proxy.[mM][pP]4'):
-        code = video_path.stem.split('_')[1]  # MVI_XXXX_proxy -> XXXX
-        if code.isdigit():
-            existing_codes.add(int(code))
-    
     # Try to extract a 4-digit code from the uploaded filename
-    code_from_filename = None
-    # Look for any 4-digit sequence surrounded by non-digits (or at string boundaries)
-    matches = re.findall(r'(?:^|\D)(\d{4})(?:\D|$)', video_file.filename)
-    
-    if matches:
-        # Use the first 4-digit code found
-        potential_code = int(matches[0])
-        # Check if this code is available
-        if potential_code not in existing_codes and 1 <= potential_code <= 9999:
-            code_from_filename = f"{potential_code:04d}"
-    
-    if code_from_filename:
-        # Use the code from filename
-        code = code_from_filename
-    else:
-        # Find the next available code (starting from 0001)
-        next_code = 1
-        while next_code in existing_codes and next_code <= 9999:
-            next_code += 1
+    # Look for the first 4-digit sequence surrounded by non-digits (or at string boundaries)
+    match = _FILENAME_CODE_RE.search(original_filename)
+    potential_code = int(match.group(1)) if match else None
+    
+    # Use the code from the filename if it's available, otherwise the next free one
+    # (starting from 0001). It stays reserved until the video is in place
+    next_code = reserve_code(potential_code)
+    if next_code is None:
+        return jsonify({'error': 'Maximum video limit reached (9999)'}), 400
+    
+    # Format code as 4-digit string
+    code = f"{next_code:04d}"
+    try:
+        # Save video with MVI naming convention
+        video_extension = os.path.splitext(original_filename)[1].lower()
+        video_filename = f"MVI_{code}_proxy{video_extension}"
+        video_path = videos_dir / video_filename
         
-        if next_code > 9999:
-            return jsonify({'error': 'Maximum video limit reached (9999)'}), 400
+        # Both kinds of upload land in a spool file in videos/ first, so an interrupted
+        # upload never shows up as a video and the finished one is renamed, not copied.
+        # waitress has already written the body to its own buffer file before this runs
+        if raw_upload:
+            with request.spool_file() as f:
+                while chunk := request.stream.read(1 << 20):
+                    f.write(chunk)
+            spool_path = f.name
+        else:
+            # Close the spooled part first; Windows can't rename an open file
+            video_file.stream.close()
+            spool_path = video_file.stream.name
+        os.replace(spool_path, video_path)
+        invalidate_media_index()
         
-        # Format code as 4-digit string
-        code = f"{next_code:04d}"
-    
-    # Save video with MVI naming convention
-    video_extension = Path(video_file.filename).suffix.lower()
-    video_filename = f"MVI_{code}_proxy{video_extension}"
-    video_path = videos_dir / video_filename
-    
-    video_file.save(str(video_path))
-    
-    # Store the mapping of MVI code to original filename
-    VIDEO_UPLOAD_MAPPING[code] = {
-        'original_filename': video_file.filename,
-        'uploaded_filename': video_filename,
-        'upload_timestamp': time.time()
-    }
-    save_upload_mapping()
-    
-    return jsonify({
-        'code': code,
-        'video_filename': video_filename,
-        'original_filename': video_file.filename,
-        'message': f'Video uploaded successfully with code {code}. You can now run detection.'
-    })
+        # Store the mapping of MVI code to original filename
+        VIDEO_UPLOAD_MAPPING[code] = {
+            'original_filename': original_filename,
+            'uploaded_filename': video_filename,
+            'upload_timestamp': time.time()
+        }
+        save_upload_mapping()
+        
+        return jsonify({
+            'code': code,
+            'video_filename': video_filename,
+            'original_filename': original_filename,
+            'message': f'Video uploaded successfully with code {code}. You can now run detection.'
+        })
+    finally:
+        release_code(next_code)
+def send_media_file(directory, filename):
+    """Serve a media file, handing the transfer to the front-end server when configured.
+
+    Standalone, send_from_directory wraps the file with the server's wsgi.file_wrapper,
+    which lets servers that support it use sendfile(2) instead of a Python read loop.
+    nginx keeps the Cache-Control header set here when it serves an X-Accel-Redirect.
+    """
+    # URLs carrying a ?v= version (see get_media_index) never change content, so the
+    # browser can keep them instead of revalidating on every seek
+    max_age = 31536000 if request.args.get('v') else None
+    
+    prefix = app.config['X_ACCEL_REDIRECT_PREFIX']
+    if prefix:
+        internal_path = safe_join(f"{prefix.rstrip('/')}/{directory}", filename)
+        if internal_path is None:
+            abort(404)
+        # nginx keeps the Content-Type of the redirecting response, so set the file's own
+        # type here rather than Flask's text/html default
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        response = Response(mimetype=mimetype, headers={'X-Accel-Redirect': internal_path})
+    else:
+        # Conditional responses honour Range headers, so video seeks only read the
+        # requested byte window (206 Partial Content) instead of the whole file
+        response = send_from_directory(directory, filename, conditional=True, max_age=max_age)
+    
+    if max_age:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+        response.cache_control.immutable = True
+    return response
+
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return send_media_file(app.config['UPLOAD_FOLDER'], filename)
 
 @app.route('/videos/<filename>')
 def video_file(filename):
-    return send_from_directory('videos', filename)
+    return send_media_file('videos', filename)
 
-@app.route('/load-by-code/<code>')
+@app.route('/load-by-code/<code:code>')
 def load_by_code(code):
-    # Validate code is 4 digits
-    if not code.isdigit() or len(code) != 4:
-        return jsonify({'error': 'Invalid code format. Must be 4 digits.'}), 400
-    
-    # Define the base paths
-    keyframes_dir = Path('videos_keyframes')
-    video_dir = Path('videos')
-    
     # Construct file paths
-    keyframes_filename = f'MVI_{code}_keyframes.json'
-    keyframes_path = keyframes_dir / keyframes_filename
-    
-    # Check for video file with both .mp4 and .MP4 extensions
-    video_filename_lower = f'MVI_{code}_proxy.mp4'
-    video_filename_upper = f'MVI_{code}_proxy.MP4'
+    keyframes_path = f'videos_keyframes/MVI_{code}_keyframes.json'
     
-    video_path = None
-    if (video_dir / video_filename_lower).exists():
-        video_path = video_dir / video_filename_lower
-    elif (video_dir / video_filename_upper).exists():
-        video_path = video_dir / video_filename_upper
+    # Look up the video (either .mp4 or .MP4) and keyframes in the directory index
+    _, _, keyframe_codes, _, video_urls = media_index()
+    video_url = video_urls.get(code)  # prebuilt '/videos/MVI_XXXX_proxy.mp4'
     
     # Check if files exist
-    if not keyframes_path.exists():
+    if code not in keyframe_codes:
         return jsonify({'error': f'Keyframes file not found for code {code}'}), 404
     
-    if not video_path:
+    if not video_url:
         return jsonify({'error': f'Video file not found for code {code}'}), 404
     
-    # Load keyframes data
+    # Load keyframes data and reuse the encoded body while the file is unchanged
+    use_gzip = request.accept_encodings['gzip'] > 0
     try:
-        with open(keyframes_path, 'r') as f:
-            keyframes_data = json.load(f)
-    except json.JSONDecodeError:
+        st = os.stat(keyframes_path)
+        # The plain body is written out chunk by chunk rather than joined into one
+        # string, so the large keyframes blob is never copied per request
+        encode = _gzip_load_response if use_gzip else _load_response_chunks
+        body = encode(keyframes_path, st.st_mtime_ns, st.st_size, video_url)
+    except orjson.JSONDecodeError:
         return jsonify({'error': 'Invalid keyframes JSON file'}), 400
     
     # Use the existing video path directly
-    return jsonify({
-        'video_url': f'/{video_path}',
-        'keyframes': keyframes_data
-    })
+    response = Response(body, mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    if use_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
 
-@app.route('/video-thumbnail/<code>')
+@app.route('/video-thumbnail/<code:code>')
 def video_thumbnail(code):
     """Generate or serve a cached thumbnail for a video"""
-    # Validate code is 4 digits
-    if not code.isdigit() or len(code) != 4:
-        return jsonify({'error': 'Invalid code format. Must be 4 digits.'}), 400
-    
     # Check for cached thumbnail first
     thumbnail_dir = Path('thumbnails')
     thumbnail_path = thumbnail_dir / f'MVI_{code}_thumb.jpg'
@@ -220,18 +664,9 @@ def video_thumbnail(code):
         # Serve cached thumbnail
         return send_file(str(thumbnail_path), mimetype='image/jpeg')
     
-    # Find the video file
-    video_dir = Path('videos')
-    video_path = None
-    
-    # Check for video file with both .mp4 and .MP4 extensions
-    video_filename_lower = f'MVI_{code}_proxy.mp4'
-    video_filename_upper = f'MVI_{code}_proxy.MP4'
-    
-    if (video_dir / video_filename_lower).exists():
-        video_path = video_dir / video_filename_lower
-    elif (video_dir / video_filename_upper).exists():
-        video_path = video_dir / video_filename_upper
+    # Find the video file (either .mp4 or .MP4) with a single index lookup
+    videos, _ = get_media_index()
+    video_path = videos.get(code)
     
     if not video_path:
         return jsonify({'error': f'Video file not found for code {code}'}), 404
@@ -308,55 +743,41 @@ def video_thumbnail(code):
         print(f"Error generating thumbnail for {code}: {str(e)}")
         return jsonify({'error': f'Failed to generate thumbnail: {str(e)}'}), 500
 
-@app.route('/check-keyframes/<code>')
+# Every /check-keyframes answer, serialized once: {(has_video, has_keyframes, experiment_type): body}
+_CHECK_KEYFRAMES_BODIES = {
+    (has_video, has_keyframes, experiment_type): orjson.dumps({
+        'has_video': has_video,
+        'has_keyframes': has_keyframes,
+        'experiment_type': experiment_type
+    })
+    for has_video in (False, True)
+    for has_keyframes in (False, True)
+    for experiment_type in (None, 'mirror', 'social', 'control')
+}
+
+@app.route('/check-keyframes/<code:code>')
 def check_keyframes(code):
     """Check if keyframes exist for a video code"""
-    if not code.isdigit() or len(code) != 4:
-        return jsonify({'error': 'Invalid code format'}), 400
-    
     keyframes_path = Path('videos_keyframes') / f'MVI_{code}_keyframes.json'
-    video_path_lower = Path('videos') / f'MVI_{code}_proxy.mp4'
-    video_path_upper = Path('videos') / f'MVI_{code}_proxy.MP4'
+    videos, keyframe_codes = get_media_index()
     
-    has_video = video_path_lower.exists() or video_path_upper.exists()
-    has_keyframes = keyframes_path.exists()
+    has_video = code in videos
+    has_keyframes = code in keyframe_codes
     
     # Check if existing keyframes have experiment type flags
     experiment_type = None
     if has_keyframes:
-        try:
-            with open(keyframes_path, 'r') as f:
-                keyframes_data = json.load(f)
-                # Check if detection_params has experiment type flags
-                if 'detection_params' in keyframes_data:
-                    params = keyframes_data['detection_params']
-                    if params.get('is_mirror', False):
-                        experiment_type = 'mirror'
-                    elif params.get('is_social', False):
-                        experiment_type = 'social'
-                    elif params.get('is_control', False):
-                        experiment_type = 'control'
-        except (json.JSONDecodeError, IOError):
-            # If we can't read the file, default to None
-            pass
+        experiment_type = get_experiment_type(keyframes_path)
     
-    return jsonify({
-        'has_video': has_video,
-        'has_keyframes': has_keyframes,
-        'experiment_type': experiment_type
-    })
+    body = _CHECK_KEYFRAMES_BODIES[has_video, has_keyframes, experiment_type]
+    return Response(body, mimetype='application/json')
 
-@app.route('/start-detection/<code>', methods=['POST'])
+@app.route('/start-detection/<code:code>', methods=['POST'])
 def start_detection(code):
     """Start YOLO detection for a video"""
-    if not code.isdigit() or len(code) != 4:
-        return jsonify({'error': 'Invalid code format'}), 400
-    
     # Check if video exists
-    video_path_lower = Path('videos') / f'MVI_{code}_proxy.mp4'
-    video_path_upper = Path('videos') / f'MVI_{code}_proxy.MP4'
-    
-    if not (video_path_lower.exists() or video_path_upper.exists()):
+    videos, _ = get_media_index()
+    if code not in videos:
         return jsonify({'error': 'Video not found'}), 404
     
     # Get detection parameters from request
@@ -370,33 +791,33 @@ def start_detection(code):
         'status': 'started'
     })
 
+# Fixed SSE messages, encoded once; the stream yields bytes so Werkzeug has nothing to encode
+_SSE_HEARTBEAT = b': heartbeat\n\n'
+_SSE_INVALID_JOB = b'data: {"type": "error", "message": "Invalid job ID"}\n\n'
+
 @app.route('/detection-progress/<job_id>')
 def detection_progress(job_id):
     """SSE endpoint for detection progress"""
     def generate():
         progress_queue = detection_manager.get_progress_queue(job_id)
         if not progress_queue:
-            yield 'data: {"type": "error", "message": "Invalid job ID"}\n\n'
+            yield _SSE_INVALID_JOB
             return
         
         while True:
             try:
-                # Get progress update with timeout
-                progress = progress_queue.get(timeout=1.0)
-                yield f'data: {json.dumps(progress)}\n\n'
-                
-                # End stream if complete or error
-                if progress.get('type') in ['complete', 'error']:
-                    break
-                    
+                # Block until the detection thread (or a cancel request) posts an update
+                progress = progress_queue.get(timeout=15.0)
             except queue.Empty:
-                # Send heartbeat
-                yield 'data: {"type": "heartbeat"}\n\n'
+                # Keep-alive so idle connections are not dropped; an SSE comment line,
+                # which EventSource consumes without waking the page's message handler
+                yield _SSE_HEARTBEAT
+                continue
             
-            # Check if job was cancelled
-            status = detection_manager.get_job_status(job_id)
-            if status == 'cancelled':
-                yield 'data: {"type": "cancelled", "message": "Detection cancelled"}\n\n'
+            yield b'data: ' + orjson.dumps(progress) + b'\n\n'
+            
+            # End stream if complete, error or cancelled
+            if progress.get('type') in ('complete', 'error', 'cancelled'):
                 break
     
     return Response(
@@ -421,57 +842,11 @@ def cancel_detection(job_id):
 @app.route('/list-available-codes')
 def list_available_codes():
     """List all available video codes and their keyframe status"""
-    videos_dir = Path('videos')
-    keyframes_dir = Path('videos_keyframes')
-    
-    # Find all video files
-    video_files = {}
-    for video_path in videos_dir.glob('MVI_*_proxy.[mM][pP]4'):
-        # Extract code from filename
-        code = video_path.stem.split('_')[1]  # MVI_XXXX_proxy -> XXXX
-        video_files[code] = True
-    
-    # Check for corresponding keyframes and mirror status
-    codes_info = []
-    for code in sorted(video_files.keys()):
-        keyframes_path = keyframes_dir / f'MVI_{code}_keyframes.json'
-        has_keyframes = keyframes_path.exists()
-        
-        # Check if existing keyframes have experiment type flags
-        experiment_type = None
-        if has_keyframes:
-            try:
-                with open(keyframes_path, 'r') as f:
-                    keyframes_data = json.load(f)
-                    # Check if detection_params has experiment type flags
-                    if 'detection_params' in keyframes_data:
-                        params = keyframes_data['detection_params']
-                        if params.get('is_mirror', False):
-                            experiment_type = 'mirror'
-                        elif params.get('is_social', False):
-                            experiment_type = 'social'
-                        elif params.get('is_control', False):
-                            experiment_type = 'control'
-            except (json.JSONDecodeError, IOError):
-                # If we can't read the file, default to None
-                pass
-        
-        codes_info.append({
-            'code': code,
-            'has_video': True,
-            'has_keyframes': has_keyframes,
-            'experiment_type': experiment_type
-        })
-    
-    return jsonify({'codes': codes_info})
+    return Response(get_codes_response(), mimetype='application/json')
 
-@app.route('/delete-keyframes/<code>', methods=['POST'])
+@app.route('/delete-keyframes/<code:code>', methods=['POST'])
 def delete_keyframes(code):
     """Delete keyframes within a specified time range"""
-    # Validate code format (4 digits)
-    if not code.isdigit() or len(code) != 4:
-        return jsonify({'error': 'Invalid code format'}), 400
-    
     # Get request data
     data = request.get_json()
     if not data:
@@ -495,25 +870,22 @@ def delete_keyframes(code):
         return jsonify({'error': 'Keyframes file not found'}), 404
     
     try:
-        with open(keyframes_path, 'r') as f:
-            keyframes_data = json.load(f)
+        keyframes_data = read_json_file(keyframes_path)
     except Exception as e:
         return jsonify({'error': f'Failed to load keyframes: {str(e)}'}), 500
     
-    # Create backup before deletion
-    import shutil
-    from datetime import datetime
-    backup_path = keyframes_path.with_suffix(f'.backup_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json')
-    shutil.copy2(keyframes_path, backup_path)
+    # The current file becomes this backup once the updated keyframes are saved
+    backup_path = keyframes_backup_path(code)
+    
+    # Sides to process, with their per-frame keys: (side, detections key, flag key)
+    side_keys = [(side_key, f'{side_key}_detections', f'has_{side_key}_octopus')
+                 for side_key in ('left', 'right') if side in ('both', side_key)]
     
     # Count affected keyframes before processing
     affected_count = 0
-    deleted_left = 0
-    deleted_right = 0
-    infilled_left = 0
-    infilled_right = 0
-    edited_left = 0
-    edited_right = 0
+    deleted = {'left': 0, 'right': 0}
+    infilled = {'left': 0, 'right': 0}
+    edited = {'left': 0, 'right': 0}
     
     if method == 'delete':
         # Original deletion logic
@@ -524,47 +896,47 @@ def delete_keyframes(code):
                 # Check if timestamp is within range
                 if start_time <= timestamp <= end_time:
                     # Delete based on side selection
-                    if side == 'both' or side == 'left':
-                        if frame_data.get('left_detections'):
-                            deleted_left += len(frame_data['left_detections'])
-                            frame_data['left_detections'] = []
-                            frame_data['has_left_octopus'] = False
-                            affected_count += 1
-                    
-                    if side == 'both' or side == 'right':
-                        if frame_data.get('right_detections'):
-                            deleted_right += len(frame_data['right_detections'])
-                            frame_data['right_detections'] = []
-                            frame_data['has_right_octopus'] = False
+                    for side_key, detections_key, flag_key in side_keys:
+                        if frame_data.get(detections_key):
+                            deleted[side_key] += len(frame_data[detections_key])
+                            frame_data[detections_key] = []
+                            frame_data[flag_key] = False
                             affected_count += 1
     
     elif method == 'infill':
         # Infill interpolation logic
         if 'keyframes' in keyframes_data:
+            # Sort keyframes by frame number once for both sides; timestamps grow with the
+            # frame number, so the selected range can be found by bisection
+            sorted_frames = sorted_keyframes(str(keyframes_path), keyframes_data['keyframes'])
+            timestamps = np.fromiter((frame_data.get('timestamp', 0) for _, frame_data in sorted_frames),
+                                     dtype=np.float64, count=len(sorted_frames))
+            range_start = int(np.searchsorted(timestamps, start_time, side='left'))
+            range_end = int(np.searchsorted(timestamps, end_time, side='right'))
+            frames_in_range = sorted_frames[range_start:range_end]
+            
             # Helper function to find boundary keyframes with detections
             def find_boundary_keyframes(side_key):
                 prev_frame = None
                 next_frame = None
                 prev_timestamp = None
                 next_timestamp = None
+                detections_key = f'{side_key}_detections'
                 
-                # Sort keyframe keys by frame number
-                sorted_frames = sorted(keyframes_data['keyframes'].items(), 
-                                     key=lambda x: int(x[0]))
-                
-                # Find previous frame with detection
-                for frame_key, frame_data in sorted_frames:
-                    timestamp = frame_data.get('timestamp', 0)
-                    if timestamp < start_time and frame_data.get(f'{side_key}_detections'):
+                # Walk back from the range to the nearest earlier frame with a detection
+                for i in range(range_start - 1, -1, -1):
+                    frame_data = sorted_frames[i][1]
+                    if frame_data.get(detections_key):
                         prev_frame = frame_data
-                        prev_timestamp = timestamp
+                        prev_timestamp = frame_data.get('timestamp', 0)
+                        break
                 
-                # Find next frame with detection
-                for frame_key, frame_data in sorted_frames:
-                    timestamp = frame_data.get('timestamp', 0)
-                    if timestamp > end_time and frame_data.get(f'{side_key}_detections'):
+                # Walk forward from the range to the nearest later frame with a detection
+                for i in range(range_end, len(sorted_frames)):
+                    frame_data = sorted_frames[i][1]
+                    if frame_data.get(detections_key):
                         next_frame = frame_data
-                        next_timestamp = timestamp
+                        next_timestamp = frame_data.get('timestamp', 0)
                         break
                 
                 return prev_frame, prev_timestamp, next_frame, next_timestamp
@@ -592,87 +964,45 @@ def delete_keyframes(code):
                     'side': detections[0]['side']
                 }
             
-            # Process left side if needed
-            if side == 'both' or side == 'left':
-                prev_frame, prev_ts, next_frame, next_ts = find_boundary_keyframes('left')
+            # Process each requested side
+            for side_key, detections_key, flag_key in side_keys:
+                prev_frame, prev_ts, next_frame, next_ts = find_boundary_keyframes(side_key)
                 
                 if prev_frame or next_frame:
                     # Get union bboxes for boundaries
-                    prev_bbox = compute_union_bbox(prev_frame['left_detections']) if prev_frame else None
-                    next_bbox = compute_union_bbox(next_frame['left_detections']) if next_frame else None
+                    prev_bbox = compute_union_bbox(prev_frame[detections_key]) if prev_frame else None
+                    next_bbox = compute_union_bbox(next_frame[detections_key]) if next_frame else None
                     
-                    # Process frames in range
-                    for frame_key, frame_data in keyframes_data['keyframes'].items():
-                        timestamp = frame_data.get('timestamp', 0)
+                    if prev_bbox and next_bbox:
+                        # Interpolate every frame in range at once
+                        fields = ('x_min', 'y_min', 'x_max', 'y_max', 'confidence')
+                        interpolated = interpolate_boxes(
+                            np.array([prev_bbox[k] for k in fields], dtype=np.float64),
+                            np.array([next_bbox[k] for k in fields], dtype=np.float64),
+                            timestamps[range_start:range_end], prev_ts, next_ts
+                        )
                         
-                        if start_time <= timestamp <= end_time:
-                            if prev_bbox and next_bbox:
-                                # Interpolate between prev and next
-                                weight = (timestamp - prev_ts) / (next_ts - prev_ts)
-                                interpolated = {
-                                    'x_min': prev_bbox['x_min'] + (next_bbox['x_min'] - prev_bbox['x_min']) * weight,
-                                    'y_min': prev_bbox['y_min'] + (next_bbox['y_min'] - prev_bbox['y_min']) * weight,
-                                    'x_max': prev_bbox['x_max'] + (next_bbox['x_max'] - prev_bbox['x_max']) * weight,
-                                    'y_max': prev_bbox['y_max'] + (next_bbox['y_max'] - prev_bbox['y_max']) * weight,
-                                    'confidence': prev_bbox['confidence'] + (next_bbox['confidence'] - prev_bbox['confidence']) * weight,
-                                    'side': 'left',
-                                    'interpolated': True
-                                }
-                                frame_data['left_detections'] = [interpolated]
-                                frame_data['has_left_octopus'] = True
-                                infilled_left += 1
-                            elif prev_bbox:
-                                # Only prev available, copy forward
-                                frame_data['left_detections'] = [{**prev_bbox, 'interpolated': True}]
-                                frame_data['has_left_octopus'] = True
-                                infilled_left += 1
-                            elif next_bbox:
-                                # Only next available, copy backward
-                                frame_data['left_detections'] = [{**next_bbox, 'interpolated': True}]
-                                frame_data['has_left_octopus'] = True
-                                infilled_left += 1
-                            affected_count += 1
-            
-            # Process right side if needed
-            if side == 'both' or side == 'right':
-                prev_frame, prev_ts, next_frame, next_ts = find_boundary_keyframes('right')
-                
-                if prev_frame or next_frame:
-                    # Get union bboxes for boundaries
-                    prev_bbox = compute_union_bbox(prev_frame['right_detections']) if prev_frame else None
-                    next_bbox = compute_union_bbox(next_frame['right_detections']) if next_frame else None
+                        for (frame_key, frame_data), (x_min, y_min, x_max, y_max, confidence) in zip(
+                                frames_in_range, interpolated.tolist()):
+                            frame_data[detections_key] = [{
+                                'x_min': x_min,
+                                'y_min': y_min,
+                                'x_max': x_max,
+                                'y_max': y_max,
+                                'confidence': confidence,
+                                'side': side_key,
+                                'interpolated': True
+                            }]
+                            frame_data[flag_key] = True
+                    else:
+                        # Only one boundary available, copy it across the range
+                        bbox = prev_bbox or next_bbox
+                        for frame_key, frame_data in frames_in_range:
+                            frame_data[detections_key] = [{**bbox, 'interpolated': True}]
+                            frame_data[flag_key] = True
                     
-                    # Process frames in range
-                    for frame_key, frame_data in keyframes_data['keyframes'].items():
-                        timestamp = frame_data.get('timestamp', 0)
-                        
-                        if start_time <= timestamp <= end_time:
-                            if prev_bbox and next_bbox:
-                                # Interpolate between prev and next
-                                weight = (timestamp - prev_ts) / (next_ts - prev_ts)
-                                interpolated = {
-                                    'x_min': prev_bbox['x_min'] + (next_bbox['x_min'] - prev_bbox['x_min']) * weight,
-                                    'y_min': prev_bbox['y_min'] + (next_bbox['y_min'] - prev_bbox['y_min']) * weight,
-                                    'x_max': prev_bbox['x_max'] + (next_bbox['x_max'] - prev_bbox['x_max']) * weight,
-                                    'y_max': prev_bbox['y_max'] + (next_bbox['y_max'] - prev_bbox['y_max']) * weight,
-                                    'confidence': prev_bbox['confidence'] + (next_bbox['confidence'] - prev_bbox['confidence']) * weight,
-                                    'side': 'right',
-                                    'interpolated': True
-                                }
-                                frame_data['right_detections'] = [interpolated]
-                                frame_data['has_right_octopus'] = True
-                                infilled_right += 1
-                            elif prev_bbox:
-                                # Only prev available, copy forward
-                                frame_data['right_detections'] = [{**prev_bbox, 'interpolated': True}]
-                                frame_data['has_right_octopus'] = True
-                                infilled_right += 1
-                            elif next_bbox:
-                                # Only next available, copy backward
-                                frame_data['right_detections'] = [{**next_bbox, 'interpolated': True}]
-                                frame_data['has_right_octopus'] = True
-                                infilled_right += 1
-                            affected_count += 1
+                    infilled[side_key] += len(frames_in_range)
+                    affected_count += len(frames_in_range)
     
     elif method == 'edit':
         # Handle edits (additions/modifications)
@@ -706,16 +1036,27 @@ def delete_keyframes(code):
             
             return True, None
         
-        # Validate bbox updates based on side
-        if (side == 'both' or side == 'left') and 'left' in bbox_update:
-            valid, error = validate_bbox(bbox_update['left'], 'left')
-            if not valid:
-                return jsonify({'error': error}), 400
-        
-        if (side == 'both' or side == 'right') and 'right' in bbox_update:
-            valid, error = validate_bbox(bbox_update['right'], 'right')
-            if not valid:
-                return jsonify({'error': error}), 400
+        # Validate bbox updates based on side, and build each side's detection once
+        edit_keys = []
+        for side_key, detections_key, flag_key in side_keys:
+            if side_key in bbox_update:
+                valid, error = validate_bbox(bbox_update[side_key], side_key)
+                if not valid:
+                    return jsonify({'error': error}), 400
+                
+                # Extract bbox from nested structure
+                bbox = bbox_update[side_key]['bbox']
+                # Create properly formatted detection
+                detection = {
+                    'x_min': bbox['x_min'],
+                    'y_min': bbox['y_min'],
+                    'x_max': bbox['x_max'],
+                    'y_max': bbox['y_max'],
+                    'confidence': bbox.get('confidence', 0.9),  # Default confidence if not provided
+                    'side': side_key,
+                    'edited': True  # Mark as edited for tracking
+                }
+                edit_keys.append((side_key, detections_key, flag_key, detection))
         
         # Process keyframes
         if 'keyframes' in keyframes_data:
@@ -725,88 +1066,46 @@ def delete_keyframes(code):
                 # Check if timestamp is within range
                 if start_time <= timestamp <= end_time:
                     # Update based on side selection
-                    if (side == 'both' or side == 'left') and 'left' in bbox_update:
-                        # Extract bbox from nested structure
-                        left_bbox = bbox_update['left']['bbox']
-                        # Create properly formatted detection
-                        left_detection = {
-                            'x_min': left_bbox['x_min'],
-                            'y_min': left_bbox['y_min'],
-                            'x_max': left_bbox['x_max'],
-                            'y_max': left_bbox['y_max'],
-                            'confidence': left_bbox.get('confidence', 0.9),  # Default confidence if not provided
-                            'side': 'left',
-                            'edited': True  # Mark as edited for tracking
-                        }
-                        frame_data['left_detections'] = [left_detection]
-                        frame_data['has_left_octopus'] = True
-                        edited_left += 1
-                    
-                    if (side == 'both' or side == 'right') and 'right' in bbox_update:
-                        # Extract bbox from nested structure
-                        right_bbox = bbox_update['right']['bbox']
-                        # Create properly formatted detection
-                        right_detection = {
-                            'x_min': right_bbox['x_min'],
-                            'y_min': right_bbox['y_min'],
-                            'x_max': right_bbox['x_max'],
-                            'y_max': right_bbox['y_max'],
-                            'confidence': right_bbox.get('confidence', 0.9),  # Default confidence if not provided
-                            'side': 'right',
-                            'edited': True  # Mark as edited for tracking
-                        }
-                        frame_data['right_detections'] = [right_detection]
-                        frame_data['has_right_octopus'] = True
-                        edited_right += 1
+                    for side_key, detections_key, flag_key, detection in edit_keys:
+                        frame_data[detections_key] = [dict(detection)]
+                        frame_data[flag_key] = True
+                        edited[side_key] += 1
                     
                     affected_count += 1
     
-    # Save updated keyframes
+    # Save updated keyframes to a temp file, link the current file as the backup, then
+    # rename the temp file over it; the live file exists at every point along the way
+    tmp_path = keyframes_path.with_suffix('.json.tmp')
+    backup_made = False
     try:
-        with open(keyframes_path, 'w') as f:
-            json.dump(keyframes_data, f, indent=2)
+        write_file(tmp_path, orjson.dumps(keyframes_data))
+        link_or_copy_file(keyframes_path, backup_path)
+        backup_made = True
+        os.replace(tmp_path, keyframes_path)
+        invalidate_media_index()
     except Exception as e:
-        # Restore from backup if save fails
-        shutil.move(backup_path, keyframes_path)
+        # The live file is untouched; drop the backup of it that this save made
+        if backup_made:
+            backup_path.unlink(missing_ok=True)
+        tmp_path.unlink(missing_ok=True)
         return jsonify({'error': f'Failed to save keyframes: {str(e)}'}), 500
     
-    # Print summary
-    if method == 'delete':
-        print(f"=== KEYFRAME DELETION COMPLETED ===")
-        print(f"Video ID: MVI_{code}")
-        print(f"Method: DELETE")
-        print(f"Side: {side.upper()}")
-        print(f"Time Range: {start_time}s - {end_time}s")
-        print(f"Frames Range: {start_frame} - {end_frame}")
-        print(f"Keyframes Affected: {affected_count}")
-        print(f"Left Detections Deleted: {deleted_left}")
-        print(f"Right Detections Deleted: {deleted_right}")
-        print(f"Backup Created: {backup_path.name}")
-        print(f"===================================")
-    elif method == 'infill':
-        print(f"=== KEYFRAME INFILL COMPLETED ===")
-        print(f"Video ID: MVI_{code}")
-        print(f"Method: INFILL")
-        print(f"Side: {side.upper()}")
-        print(f"Time Range: {start_time}s - {end_time}s")
-        print(f"Frames Range: {start_frame} - {end_frame}")
-        print(f"Keyframes Affected: {affected_count}")
-        print(f"Left Keyframes Infilled: {infilled_left}")
-        print(f"Right Keyframes Infilled: {infilled_right}")
-        print(f"Backup Created: {backup_path.name}")
-        print(f"===================================")
-    elif method == 'edit':
-        print(f"=== KEYFRAME EDIT COMPLETED ===")
-        print(f"Video ID: MVI_{code}")
-        print(f"Method: EDIT")
-        print(f"Side: {side.upper()}")
-        print(f"Time Range: {start_time}s - {end_time}s")
-        print(f"Frames Range: {start_frame} - {end_frame}")
-        print(f"Keyframes Affected: {affected_count}")
-        print(f"Left Keyframes Edited: {edited_left}")
-        print(f"Right Keyframes Edited: {edited_right}")
-        print(f"Backup Created: {backup_path.name}")
-        print(f"===================================")
+    # Log a summary, as one record so the block is written in a single call off-thread
+    summary = {
+        'delete': ('KEYFRAME DELETION COMPLETED', 'Detections Deleted', deleted),
+        'infill': ('KEYFRAME INFILL COMPLETED', 'Keyframes Infilled', infilled),
+        'edit': ('KEYFRAME EDIT COMPLETED', 'Keyframes Edited', edited),
+    }.get(method)
+    if summary:
+        title, count_label, counts = summary
+        log.info(
+            "=== %s ===\nVideo ID: MVI_%s\nMethod: %s\nSide: %s\nTime Range: %ss - %ss\n"
+            "Frames Range: %s - %s\nKeyframes Affected: %s\nLeft %s: %s\nRight %s: %s\n"
+            "Backup Created: %s\n===================================",
+            title, code, method.upper(), side.upper(), start_time, end_time,
+            start_frame, end_frame, affected_count, count_label, counts['left'],
+            count_label, counts['right'], backup_path.name
+        )
     
     return jsonify({
         'success': True,
@@ -817,72 +1116,93 @@ def delete_keyframes(code):
         'start_time': start_time,
         'end_time': end_time,
         'keyframes_affected': affected_count,
-        'left_detections_deleted': deleted_left if method == 'delete' else 0,
-        'right_detections_deleted': deleted_right if method == 'delete' else 0,
-        'left_keyframes_infilled': infilled_left if method == 'infill' else 0,
-        'right_keyframes_infilled': infilled_right if method == 'infill' else 0,
-        'left_keyframes_edited': edited_left if method == 'edit' else 0,
-        'right_keyframes_edited': edited_right if method == 'edit' else 0,
+        'left_detections_deleted': deleted['left'] if method == 'delete' else 0,
+        'right_detections_deleted': deleted['right'] if method == 'delete' else 0,
+        'left_keyframes_infilled': infilled['left'] if method == 'infill' else 0,
+        'right_keyframes_infilled': infilled['right'] if method == 'infill' else 0,
+        'left_keyframes_edited': edited['left'] if method == 'edit' else 0,
+        'right_keyframes_edited': edited['right'] if method == 'edit' else 0,
         'backup_file': backup_path.name
     })
-@app.route('/list-backups/<code>')
+
+# {code: (videos_keyframes/ mtime, backup list)}. Backups are only ever added or
+# removed, never edited, so the directory mtime is enough to tell when a list is stale
+_BACKUP_LISTS = {}
+# Backup filename timestamp: YYYYMMDD_HHMMSS, plus _NNNNNNNNN nanoseconds on newer backups
+_BACKUP_TIMESTAMP_RE = re.compile(r'(\d{4})(\d{2})(\d{2})_(\d{2})(\d{2})(\d{2})(?:_\d{9})?')
+# A full backup filename as list-backups reports it: MVI_XXXX_keyframes.backup_YYYYMMDD_HHMMSS[_NNNNNNNNN].json
+_BACKUP_FILENAME_RE = re.compile(r'MVI_([0-9]{4})_keyframes\.backup_[0-9]{8}_[0-9]{6}(?:_[0-9]{9})?\.json')
+
+@app.route('/list-backups/<code:code>')
 def list_backups(code):
     """List all backup files for a given video code"""
-    # Validate code format (4 digits)
-    if not code.isdigit() or len(code) != 4:
-        return jsonify({'error': 'Invalid code format'}), 400
-    
     keyframes_dir = Path('videos_keyframes')
-    backup_pattern = f'MVI_{code}_keyframes.backup_*.json'
+    backup_prefix = f'MVI_{code}_keyframes.backup_'
+    
+    dir_mtime = keyframes_dir.stat().st_mtime_ns
+    cached = _BACKUP_LISTS.get(code)
+    if cached and cached[0] == dir_mtime:
+        return jsonify({
+            'code': code,
+            'backups': cached[1]
+        })
     
     backups = []
-    for backup_path in keyframes_dir.glob(backup_pattern):
+    with os.scandir(keyframes_dir) as entries:
+        backup_entries = [entry for entry in entries
+                          if entry.name.startswith(backup_prefix) and entry.name.endswith('.json')]
+    for entry in backup_entries:
         # Extract timestamp from filename
         # Format: MVI_XXXX_keyframes.backup_YYYYMMDD_HHMMSS.json
-        timestamp_str = backup_path.stem.split('backup_')[1]
+        timestamp_str = entry.name[len(backup_prefix):-len('.json')]
         
         try:
-            # Parse timestamp
-            from datetime import datetime
-            timestamp = datetime.strptime(timestamp_str, '%Y%m%d_%H%M%S')
+            # Parse timestamp; the fields are sliced out directly rather than via strptime
+            match = _BACKUP_TIMESTAMP_RE.fullmatch(timestamp_str)
+            if not match:
+                raise ValueError(f'unexpected backup timestamp {timestamp_str!r}')
+            year, month, day, hour, minute, second = match.groups()
+            datetime(int(year), int(month), int(day), int(hour), int(minute), int(second))  # range check
             
             # Get file stats
-            stats = backup_path.stat()
+            stats = entry.stat()
             
             backups.append({
-                'filename': backup_path.name,
-                'timestamp': timestamp.isoformat(),
-                'timestamp_str': timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+                'filename': entry.name,
+                'timestamp': f'{year}-{month}-{day}T{hour}:{minute}:{second}',
+                'timestamp_str': f'{year}-{month}-{day} {hour}:{minute}:{second}',
                 'size': stats.st_size,
                 'size_str': f'{stats.st_size / 1024:.1f} KB'
             })
         except Exception as e:
-            print(f"Error parsing backup file {backup_path}: {e}")
+            print(f"Error parsing backup file {entry.path}: {e}")
             continue
     
     # Sort by timestamp, newest first
-    backups.sort(key=lambda x: x['timestamp'], reverse=True)
+    backups.sort(key=lambda x: (x['timestamp'], x['filename']), reverse=True)
+    
+    # Same settle window as the media index: a backup written in the last tick could
+    # still change size without the directory mtime moving
+    if time.time_ns() - dir_mtime > _MEDIA_INDEX_SETTLE_NS:
+        _BACKUP_LISTS[code] = (dir_mtime, backups)
     
     return jsonify({
         'code': code,
         'backups': backups
     })
 
-@app.route('/restore-backup/<code>', methods=['POST'])
+@app.route('/restore-backup/<code:code>', methods=['POST'])
 def restore_backup(code):
     """Restore a backup file as the current keyframes file"""
-    # Validate code format (4 digits)
-    if not code.isdigit() or len(code) != 4:
-        return jsonify({'error': 'Invalid code format'}), 400
-    
     data = request.get_json()
     if not data or 'backup_filename' not in data:
         return jsonify({'error': 'backup_filename is required'}), 400
     
     backup_filename = data['backup_filename']
     
-    # Validate backup filename format
-    if not backup_filename.startswith(f'MVI_{code}_keyframes.backup_') or not backup_filename.endswith('.json'):
+    # Validate backup filename format; matching the whole name also keeps path separators out
+    match = _BACKUP_FILENAME_RE.fullmatch(backup_filename) if isinstance(backup_filename, str) else None
+    if not match or match.group(1) != code:
         return jsonify({'error': 'Invalid backup filename'}), 400
     
     keyframes_dir = Path('videos_keyframes')
@@ -894,18 +1214,22 @@ def restore_backup(code):
         return jsonify({'error': 'Backup file not found'}), 404
     
     try:
-        # Create a backup of the current file before restoring
-        import shutil
-        from datetime import datetime
+        # The restored copy goes through a temp file rather than being written over the
+        # current file in place, since that is about to share its data with a hard-linked
+        # backup. It's taken first in case the new backup's name is the one being restored
+        tmp_path = current_keyframes_path.with_suffix('.json.tmp')
+        copy_file(backup_path, tmp_path)
         
-        if current_keyframes_path.exists():
-            pre_restore_backup = current_keyframes_path.with_suffix(
-                f'.backup_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json'
-            )
-            shutil.copy2(current_keyframes_path, pre_restore_backup)
+        # Create a backup of the current file before restoring
+        pre_restore_backup = keyframes_backup_path(code)
+        try:
+            link_or_copy_file(current_keyframes_path, pre_restore_backup)
+        except FileNotFoundError:
+            pass  # no current keyframes to back up
         
         # Restore the backup
-        shutil.copy2(backup_path, current_keyframes_path)
+        os.replace(tmp_path, current_keyframes_path)
+        invalidate_media_index()
         
         return jsonify({
             'success': True,
@@ -915,13 +1239,9 @@ def restore_backup(code):
     except Exception as e:
         return jsonify({'error': f'Failed to restore backup: {str(e)}'}), 500
 
-@app.route('/get-upload-mapping/<code>')
+@app.route('/get-upload-mapping/<code:code>')
 def get_upload_mapping(code):
     """Get the original upload information for a specific MVI code"""
-    # Validate code format (4 digits)
-    if not code.isdigit() or len(code) != 4:
-        return jsonify({'error': 'Invalid code format'}), 400
-    
     # Check if mapping exists for this code
     if code in VIDEO_UPLOAD_MAPPING:
         return jsonify({
@@ -935,27 +1255,37 @@ def get_upload_mapping(code):
             'message': 'No upload mapping found for this code'
         })
 
+# (_mapping_version it was built from, serialized /get-all-upload-mappings body, ETag)
+_MAPPINGS_RESPONSE = (None, b'', '')
+
 @app.route('/get-all-upload-mappings')
 def get_all_upload_mappings():
     """Get all upload mappings for export purposes"""
-    return jsonify({
-        'mappings': VIDEO_UPLOAD_MAPPING,
-        'total_count': len(VIDEO_UPLOAD_MAPPING)
-    })
+    global _MAPPINGS_RESPONSE
+    if _MAPPINGS_RESPONSE[0] != _mapping_version:
+        version = _mapping_version
+        body = orjson.dumps({
+            'mappings': VIDEO_UPLOAD_MAPPING,
+            'total_count': len(VIDEO_UPLOAD_MAPPING)
+        })
+        # Content hash rather than the version, which restarts from 0 with the server
+        _MAPPINGS_RESPONSE = (version, body, hashlib.blake2b(body, digest_size=8).hexdigest())
+    _, body, etag = _MAPPINGS_RESPONSE
+    
+    # Pollers that already have this version just get a 304
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    return response
 
-@app.route('/import-keyframes/<code>', methods=['POST'])
+@app.route('/import-keyframes/<code:code>', methods=['POST'])
 def import_keyframes(code):
     """Import keyframes JSON file for a specific video code"""
-    # Validate code format (4 digits)
-    if not code.isdigit() or len(code) != 4:
-        return jsonify({'error': 'Invalid code format'}), 400
-    
     # Check if video exists
-    videos_dir = Path('videos')
-    video_path_lower = videos_dir / f'MVI_{code}_proxy.mp4'
-    video_path_upper = videos_dir / f'MVI_{code}_proxy.MP4'
-    
-    if not (video_path_lower.exists() or video_path_upper.exists()):
+    video_files, _ = get_media_index()
+    if code not in video_files:
         return jsonify({'error': f'Video not found for code {code}'}), 404
     
     # Check if keyframes file was uploaded
@@ -972,9 +1302,12 @@ def import_keyframes(code):
         return jsonify({'error': 'File must be a JSON file'}), 400
     
     try:
-        # Read and parse the uploaded JSON
-        keyframes_content = keyframes_file.read()
-        keyframes_data = json.loads(keyframes_content)
+        # The upload was spooled into videos_keyframes/ (see UploadRequest), so parse it
+        # from there instead of reading it into memory, and later rename it into place.
+        # Close it first; Windows can't rename an open file
+        keyframes_file.stream.close()
+        spool_path = keyframes_file.stream.name
+        keyframes_data = read_json_file(spool_path)
         
         # Validate basic structure
         if 'keyframes' not in keyframes_data:
@@ -988,26 +1321,26 @@ def import_keyframes(code):
         keyframes_dir = Path('videos_keyframes')
         keyframes_path = keyframes_dir / f'MVI_{code}_keyframes.json'
         
-        # Create backup if existing keyframes exist
-        backup_path = None
-        if keyframes_path.exists():
-            from datetime import datetime
-            backup_path = keyframes_path.with_suffix(
-                f'.backup_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json'
-            )
-            import shutil
-            shutil.copy2(keyframes_path, backup_path)
+        # Create backup if existing keyframes exist. A hard link is enough, since the
+        # upload replaces the current file rather than writing into it
+        backup_path = keyframes_backup_path(code)
+        try:
+            link_or_copy_file(keyframes_path, backup_path)
+        except FileNotFoundError:
+            backup_path = None
         
-        # Save the new keyframes
-        with open(keyframes_path, 'w') as f:
-            json.dump(keyframes_data, f, indent=2)
+        # Save the validated upload as-is instead of re-serializing the parsed copy
+        os.replace(spool_path, keyframes_path)
+        invalidate_media_index()
         
         # Count some statistics
         total_frames = len(keyframes_data['keyframes'])
-        frames_with_left = sum(1 for frame in keyframes_data['keyframes'].values() 
-                               if frame.get('has_left_octopus', False))
-        frames_with_right = sum(1 for frame in keyframes_data['keyframes'].values() 
-                                if frame.get('has_right_octopus', False))
+        frames_with_left = frames_with_right = 0
+        for frame in keyframes_data['keyframes'].values():
+            if frame.get('has_left_octopus', False):
+                frames_with_left += 1
+            if frame.get('has_right_octopus', False):
+                frames_with_right += 1
         
         response = {
             'success': True,
@@ -1025,41 +1358,33 @@ def import_keyframes(code):
         
         return jsonify(response)
         
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         return jsonify({'error': f'Invalid JSON file: {str(e)}'}), 400
     except Exception as e:
         return jsonify({'error': f'Failed to import keyframes: {str(e)}'}), 500
 
-@app.route('/delete-video/<code>', methods=['DELETE'])
+@app.route('/delete-video/<code:code>', methods=['DELETE'])
 def delete_video(code):
     """Delete video and associated keyframes by code"""
-    # Validate code format (4 digits)
-    if not code.isdigit() or len(code) != 4:
-        return jsonify({'error': 'Invalid code format'}), 400
-    
-    # Define directories
-    videos_dir = Path('videos')
-    keyframes_dir = Path('videos_keyframes')
-    
-    # Check if video exists
-    video_path = videos_dir / f'MVI_{code}_proxy.mp4'
-    if not video_path.exists():
-        # Try uppercase extension
-        video_path = videos_dir / f'MVI_{code}_proxy.MP4'
-        if not video_path.exists():
-            return jsonify({'error': 'Video not found'}), 404
-    
-    # Check for keyframes file
-    keyframes_path = keyframes_dir / f'MVI_{code}_keyframes.json'
-    keyframes_existed = keyframes_path.exists()
+    # Check if video exists (either .mp4 or .MP4)
+    video_files, _ = get_media_index()
+    video_path = video_files.get(code)
+    if video_path is None:
+        return jsonify({'error': 'Video not found'}), 404
     
     try:
-        # Delete video file
-        video_path.unlink()
+        # Delete video file; unlink itself reports a file that is already gone
+        try:
+            os.unlink(video_path)
+        except FileNotFoundError:
+            return jsonify({'error': 'Video not found'}), 404
         
         # Delete keyframes if exists
-        if keyframes_existed:
-            keyframes_path.unlink()
+        keyframes_existed = True
+        try:
+            os.unlink(f'videos_keyframes/MVI_{code}_keyframes.json')
+        except FileNotFoundError:
+            keyframes_existed = False
         
         # Remove from upload mapping
         if code in VIDEO_UPLOAD_MAPPING:
@@ -1074,11 +1399,22 @@ def delete_video(code):
     except Exception as e:
         return jsonify({'error': f'Failed to delete: {str(e)}'}), 500
 
-import os
-
 if __name__ == '__main__':
-    if getattr(sys, 'frozen', False):
-        app.run(host='127.0.0.1', port=5172, debug=False, use_reloader=False)
+    if os.environ.get('OCTOWATCH_DEBUG'):
+        # Werkzeug dev server with reloader and debugger, for working on the app itself
+        app.run(debug=True, host='0.0.0.0', port=5172)
     else:
-        # Just try to run - Flask will error clearly if port is taken
-        app.run(debug=True, host='0.0.0.0', port=5172)
\ No newline at end of file
+        from waitress import serve
+        # Each open detection progress stream holds a thread, so keep plenty spare
+        host = '127.0.0.1' if getattr(sys, 'frozen', False) else '0.0.0.0'
+        # waitress logs its own "Serving on" line at INFO, which its default logging setup
+        # hides, so announce the address here; the README tells users to look for it
+        print(f"Serving on http://{host}:5172 (open http://localhost:5172 in your browser)", flush=True)
+        # waitress buffers every request body to its own temp file before the app sees it,
+        # so a video upload is written twice. Keep that buffer next to the uploads rather
+        # than in the system temp dir, which may be RAM-backed and too small for videos
+        os.makedirs('videos', exist_ok=True)
+        tempfile.tempdir = os.path.abspath('videos')
+        # waitress rejects bodies over 1 GiB by default; match Flask's upload limit
+        serve(app, host=host, port=5172, threads=16,
+              max_request_body_size=app.config['MAX_CONTENT_LENGTH'])
\ No newline at end of file
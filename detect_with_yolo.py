@@ -2,10 +2,12 @@
 import argparse
 import cv2
 import json
+import orjson
 from pathlib import Path
 from ultralytics import YOLO
 import torch
 import time
+import os
 from typing import Dict, List, Tuple
 from PIL import Image
 import numpy as np
@@ -13,6 +15,26 @@ from transformers import AutoModelForCausalLM
 import sys
 import moondream as md
 import platform
+import queue
+import threading
+import yaml
+from collections import deque
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+# Decoded batches the reader thread may hold ahead of inference; each is a list of full frames
+PREFETCH_BATCHES = 2
+
+# Moondream requests kept in flight while searching for the tank
+TANK_SEARCH_REQUESTS = 4
+
+# Loaded YOLO models by path, kept for the next in-process job. A job takes its model
+# out while running, since Ultralytics predictors are not safe to share between threads
+_idle_models = {}
+
+
+class DetectionCancelled(Exception):
+    """Raised inside detect_octopus_in_video when its cancel_event is set"""
 
 def emit_progress(data):
     """Emit progress update in JSON format"""
@@ -41,6 +63,16 @@ def get_best_model_format(model_base_path="default_detector"):
     openvino_path = Path(f"{model_base_path}_int8_openvino_model")
     onnx_path = Path(f"{model_base_path}.onnx")
     pt_path = Path(f"{model_base_path}.pt")
+    engine_path = Path(f"{model_base_path}.engine")
+    
+    # A TensorRT engine is built for one GPU, so only use it on CUDA, and only if it
+    # was exported after the current weights
+    if torch.cuda.is_available() and engine_path.exists():
+        if not pt_path.exists() or engine_path.stat().st_mtime >= pt_path.stat().st_mtime:
+            print(f"Using TensorRT engine for CUDA: {engine_path}")
+            print("Note: TensorRT requires 'tensorrt' package")
+            return str(engine_path)
+        print(f"Skipping {engine_path}: older than {pt_path}, re-export it")
     
     # Priority order based on platform
     if system == "darwin":  # macOS
@@ -68,83 +100,110 @@ def get_best_model_format(model_base_path="default_detector"):
         print(f"Using PyTorch model as last resort: {pt_path}")
         return str(pt_path)
     
-    raise FileNotFoundError(f"No suitable model format found. Looked for: {mlpackage_path}, {openvino_path}, {onnx_path}, {pt_path}")
+    raise FileNotFoundError(f"No suitable model format found. Looked for: {engine_path}, {mlpackage_path}, {openvino_path}, {onnx_path}, {pt_path}")
 
 
-def compute_iou(box1, box2):
-    """Compute Intersection over Union between two bounding boxes"""
-    x1 = max(box1['x_min'], box2['x_min'])
-    y1 = max(box1['y_min'], box2['y_min'])
-    x2 = min(box1['x_max'], box2['x_max'])
-    y2 = min(box1['y_max'], box2['y_max'])
-    
-    intersection = max(0, x2 - x1) * max(0, y2 - y1)
+@lru_cache(maxsize=None)
+def model_supports_batching(model_path: str) -> bool:
+    """Whether the model takes more than one image per call: PyTorch weights, or an ONNX/OpenVINO export made with dynamic=True"""
+    path = Path(model_path)
+    if path.suffix == '.pt':
+        return True
+    if path.is_dir():
+        # OpenVINO exports keep their export arguments in metadata.yaml
+        metadata_path = path / 'metadata.yaml'
+        if not metadata_path.exists():
+            return False
+        metadata = yaml.safe_load(metadata_path.read_text()) or {}
+        return bool(metadata.get('args', {}).get('dynamic', False))
+    if path.suffix == '.onnx':
+        # A dynamic export has a named batch dimension instead of a fixed size
+        import onnxruntime
+        session = onnxruntime.InferenceSession(model_path, providers=['CPUExecutionProvider'])
+        return not isinstance(session.get_inputs()[0].shape[0], int)
+    # TensorRT engines and CoreML packages are exported with a fixed batch of 1
+    return False
+
+
+def compute_iou_vec(ref, cands):
+    """Compute IoU between reference boxes and candidate boxes that broadcast against them, as (x_min, y_min, x_max, y_max)"""
+    lo = np.maximum(ref[..., :2], cands[..., :2])
+    hi = np.minimum(ref[..., 2:], cands[..., 2:])
+    intersection = np.clip(hi - lo, 0, None).prod(axis=-1)
     
-    area1 = (box1['x_max'] - box1['x_min']) * (box1['y_max'] - box1['y_min'])
-    area2 = (box2['x_max'] - box2['x_min']) * (box2['y_max'] - box2['y_min'])
+    area_ref = (ref[..., 2] - ref[..., 0]) * (ref[..., 3] - ref[..., 1])
+    areas = (cands[..., 2] - cands[..., 0]) * (cands[..., 3] - cands[..., 1])
     
-    union = area1 + area2 - intersection
+    union = area_ref + areas - intersection
     
-    return intersection / union if union > 0 else 0
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+
+def box_array(detections):
+    """Stack detection dicts into an (N, 4) array of (x_min, y_min, x_max, y_max)"""
+    return np.array([[d['x_min'], d['y_min'], d['x_max'], d['y_max']] for d in detections], dtype=np.float64)
 
 
 def preprocess_keyframes(keyframes):
-    """Preprocess keyframes to remove extra detections based on IoU with last single detection"""
-    processed_keyframes = {}
-    
-    for side in ['left', 'right']:
+    """Preprocess keyframes in place to remove extra detections based on IoU with last single detection"""
+    frames = [keyframes[k] for k in sorted(keyframes.keys(), key=int)]
+    # Detection counts for both sides in one pass, a column per side
+    counts = np.array([(len(kf['left_detections']), len(kf['right_detections'])) for kf in frames],
+                      dtype=np.int64).reshape(-1, 2)
+    frame_positions = np.arange(len(frames))
+    
+    for column, side in enumerate(['left', 'right']):
         detections_key = f'{side}_detections'
-        last_single_detection = None
-        last_single_frame = None
+        side_counts = counts[:, column]
         
-        for kf_idx in sorted([int(k) for k in keyframes.keys()]):
-            kf = keyframes[str(kf_idx)]
-            detections = kf[detections_key]
-            
-            if len(detections) == 1:
-                last_single_detection = detections[0]
-                last_single_frame = kf_idx
-            elif len(detections) > 1 and last_single_detection is not None:
-                best_detection = None
-                best_iou = -1
-                
-                for det in detections:
-                    iou = compute_iou(last_single_detection, det)
-                    if iou > best_iou:
-                        best_iou = iou
-                        best_detection = det
-                
-                if str(kf_idx) not in processed_keyframes:
-                    processed_keyframes[str(kf_idx)] = kf.copy()
-                    processed_keyframes[str(kf_idx)][detections_key] = []
-                
-                processed_keyframes[str(kf_idx)][detections_key] = [best_detection] if best_detection else []
-            else:
-                if str(kf_idx) not in processed_keyframes:
-                    processed_keyframes[str(kf_idx)] = kf.copy()
-    
-    for kf_idx in keyframes.keys():
-        if kf_idx not in processed_keyframes:
-            processed_keyframes[kf_idx] = keyframes[kf_idx]
+        # Position of the latest single-detection frame at or before each frame, -1 before the first
+        last_single = np.maximum.accumulate(np.where(side_counts == 1, frame_positions, -1))
+        multi = np.flatnonzero((side_counts > 1) & (last_single >= 0))
+        if len(multi) == 0:
+            continue
+        
+        # Pad every multi-detection frame to the same width so all of them are scored at once
+        refs = box_array([frames[i][detections_key][0] for i in last_single[multi]])
+        cands = np.zeros((len(multi), side_counts[multi].max(), 4))
+        for row, i in enumerate(multi):
+            cands[row, :side_counts[i]] = box_array(frames[i][detections_key])
+        
+        ious = compute_iou_vec(refs[:, None, :], cands)
+        # Padding never wins; argmax keeps the first best on ties, like the old strict > loop
+        ious[np.arange(cands.shape[1]) >= side_counts[multi][:, None]] = -1
+        best = ious.argmax(axis=1)
+        
+        # Only multi-detection frames change, so the reference boxes above stay valid
+        for i, b in zip(multi, best):
+            frames[i][detections_key] = [frames[i][detections_key][b]]
     
-    return processed_keyframes
+    return keyframes
+
+
+def detect_tank(model, image):
+    """Ask moondream for the tank in one image; returns (objects, found_with_water)"""
+    detections = model.detect(image, "tank with water")["objects"]
+    if detections:
+        return detections, True
+    # Try with a broader prompt
+    return model.detect(image, "tank")["objects"], False
 
 
-def find_tank_bbox(video_path, model, sample_rate=2, scale=0.5):
+def find_tank_bbox(video, model, sample_rate=2, scale=0.5, progress=emit_progress, cancel_event=None):
     """
     Find tank bounding box using progressive sampling with moondream.
     
     Args:
-        video_path: Path to input video
+        video: Open cv2.VideoCapture; left open, at whatever position the search ends
         model: Loaded moondream model
         sample_rate: Initial sample rate in Hz (default 2Hz)
         scale: Scale factor for model detection (default 0.5)
+        progress: Function that receives progress updates (default: emit_progress)
+        cancel_event: threading.Event that stops the search with DetectionCancelled
     
     Returns:
-        tuple: (found, bbox) where bbox is averaged from multiple detections
+        tuple: (found, bbox) where bbox is the median of multiple detections
     """
-    # Open video
-    video = cv2.VideoCapture(video_path)
     fps = video.get(cv2.CAP_PROP_FPS)
     frame_width = int(video.get(cv2.CAP_PROP_FRAME_WIDTH))
     frame_height = int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
@@ -152,7 +211,7 @@ def find_tank_bbox(video_path, model, sample_rate=2, scale=0.5):
     
     print(f"Searching for tank...")
     print(f"Video dimensions: {frame_width}x{frame_height}")
-    emit_progress({
+    progress({
         'type': 'progress',
         'stage': 'tank_detection',
         'message': 'Searching for tank...'
@@ -167,51 +226,63 @@ def find_tank_bbox(video_path, model, sample_rate=2, scale=0.5):
     collected_boxes = []
     first_detection_frame = None
     
-    for current_rate in sampling_rates:
-        frame_interval = int(fps / current_rate)
-        print(f"Sampling at {current_rate}Hz (every {frame_interval} frames)")
-        
-        # Reset to first detection frame or middle of video
-        start_frame = first_detection_frame if first_detection_frame is not None else middle_frame
-        video.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
-        
-        frame_count = start_frame
-        detections_this_round = 0
-        
-        while frame_count < total_frames and len(collected_boxes) < 5:
-            ret, frame = video.read()
-            if not ret:
-                break
+    # Moondream answers over the network, so several sampled frames are sent ahead
+    # instead of waiting on each request; results are still taken in frame order
+    pool = ThreadPoolExecutor(max_workers=TANK_SEARCH_REQUESTS)
+    try:
+        for current_rate in sampling_rates:
+            frame_interval = int(fps / current_rate)
+            print(f"Sampling at {current_rate}Hz (every {frame_interval} frames)")
             
-            # Check frames at specified sample rate
-            if (frame_count - start_frame) % frame_interval == 0:
-                # Convert BGR to RGB and create PIL Image
-                frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                
-                # Apply scaling if needed
-                if scale != 1.0:
-                    scaled_width = int(frame_width * scale)
-                    scaled_height = int(frame_height * scale)
-                    frame_for_detection = cv2.resize(frame_rgb, (scaled_width, scaled_height))
-                else:
-                    frame_for_detection = frame_rgb
+            # Reset to first detection frame or middle of video
+            start_frame = first_detection_frame if first_detection_frame is not None else middle_frame
+            video.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+            
+            frame_count = start_frame
+            detections_this_round = 0
+            pending = deque()  # (frame number, moondream request) in frame order
+            reading = True
+            
+            while len(collected_boxes) < 5:
+                # Read ahead until enough requests are in flight
+                if reading and len(pending) < TANK_SEARCH_REQUESTS:
+                    # grab() only advances the stream; frames between samples are never converted to BGR
+                    if frame_count >= total_frames or not video.grab():
+                        reading = False
+                        continue
+                    
+                    # Check frames at specified sample rate
+                    if (frame_count - start_frame) % frame_interval == 0:
+                        if cancel_event is not None and cancel_event.is_set():
+                            raise DetectionCancelled()
+                        
+                        ret, frame = video.retrieve()
+                        if not ret:
+                            reading = False
+                            continue
+                        
+                        # Apply scaling if needed, before the color conversion so it runs on fewer pixels
+                        if scale != 1.0:
+                            scaled_width = int(frame_width * scale)
+                            scaled_height = int(frame_height * scale)
+                            frame = cv2.resize(frame, (scaled_width, scaled_height))
+                        
+                        # Convert BGR to RGB and create PIL Image; the moondream client encodes PIL images
+                        frame_for_detection = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                        image = Image.fromarray(frame_for_detection)
+                        pending.append((frame_count, pool.submit(detect_tank, model, image)))
+                    
+                    frame_count += 1
+                    continue
                 
-                image = Image.fromarray(frame_for_detection)
+                if not pending:
+                    break
                 
                 # Detect tank
-                found_tank = False
-                found_tank_with_water = False
-                results = model.detect(image, "tank with water")
-                detections = results["objects"]
-                if not detections:
-                    # Try with a broader prompt
-                    results = model.detect(image, "tank")
-                    detections = results["objects"]
-                else:
-                    found_tank_with_water = True
+                sampled_frame, request = pending.popleft()
+                detections, found_tank_with_water = request.result()
                 
                 if detections:
-                    found_tank = True
                     # Found the tank
                     obj = detections[0]
                     
@@ -227,13 +298,13 @@ def find_tank_bbox(video_path, model, sample_rate=2, scale=0.5):
                     
                     # Remember first detection frame for finer sampling
                     if first_detection_frame is None:
-                        first_detection_frame = max(0, frame_count - int(fps * 2))  # Start 2 seconds before
+                        first_detection_frame = max(0, sampled_frame - int(fps * 2))  # Start 2 seconds before
                     
-                    print(f"Frame {frame_count}: Found tank - Box #{len(collected_boxes)}")
+                    print(f"Frame {sampled_frame}: Found tank - Box #{len(collected_boxes)}")
                     message = f"Found tank - Box #{len(collected_boxes)}"
                     if found_tank_with_water:
                         message = f"Found tank with water - Box #{len(collected_boxes)}"
-                    emit_progress({
+                    progress({
                         'type': 'progress',
                         'stage': 'tank_detection',
                         'message': message,
@@ -241,34 +312,66 @@ def find_tank_bbox(video_path, model, sample_rate=2, scale=0.5):
                         'total_boxes_needed': 5
                     })
             
-            frame_count += 1
-        
-        # Stop if we have enough boxes
-        if len(collected_boxes) >= 5:
-            break
-    
-    video.release()
+            # Requests for frames past the last box needed are not used
+            for _, request in pending:
+                request.cancel()
+            
+            # Stop if we have enough boxes
+            if len(collected_boxes) >= 5:
+                break
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
     
     if len(collected_boxes) == 0:
         return False, None
     
-    # Average all collected bounding boxes
-    avg_x_min = int(sum(box[0] for box in collected_boxes) / len(collected_boxes))
-    avg_y_min = int(sum(box[1] for box in collected_boxes) / len(collected_boxes))
-    avg_x_max = int(sum(box[2] for box in collected_boxes) / len(collected_boxes))
-    avg_y_max = int(sum(box[3] for box in collected_boxes) / len(collected_boxes))
-    avg_x_min = max(0, avg_x_min)
-    avg_y_min = max(0, avg_y_min)
-    avg_x_max = min(frame_width, avg_x_max)
-    avg_y_max = min(frame_height, avg_y_max)
-
-    
-    avg_bbox = (avg_x_min, avg_y_min, avg_x_max, avg_y_max)
+    # Take the median of the collected boxes per edge, so one stray moondream box
+    # cannot pull the tank edges the way it would pull a mean
+    frame_limits = [frame_width, frame_height, frame_width, frame_height]
+    median_bbox = np.clip(np.median(np.asarray(collected_boxes), axis=0).astype(int), 0, frame_limits)
+    x_min, y_min, x_max, y_max = median_bbox.tolist()
     
     print(f"\nCollected {len(collected_boxes)} tank bounding boxes")
-    print(f"Averaged tank bounding box: ({avg_x_min}, {avg_y_min}, {avg_x_max}, {avg_y_max})")
+    print(f"Median tank bounding box: ({x_min}, {y_min}, {x_max}, {y_max})")
+    
+    return True, (x_min, y_min, x_max, y_max)
+
+
+def half_crop_bbox(tank_bbox: Dict, side: str) -> Tuple[int, int, int, int]:
+    """Return the (x_min, y_min, x_max, y_max) crop for one half of the tank"""
+    if side == 'left':
+        return (tank_bbox['x_min'], tank_bbox['y_min'], tank_bbox['center_x'], tank_bbox['y_max'])
+    else:  # right
+        return (tank_bbox['center_x'], tank_bbox['y_min'], tank_bbox['x_max'], tank_bbox['y_max'])
+
+
+def results_to_detections(results, crop_bbox: Tuple[int, int, int, int], width: int, height: int,
+                          side: str) -> List[List[Dict]]:
+    """Convert YOLO results on a crop to detection lists in full-frame normalized coordinates"""
+    # Shift from crop space to full-frame pixels, then normalize to 0-1 range
+    offset = np.array([crop_bbox[0], crop_bbox[1], crop_bbox[0], crop_bbox[1]], dtype=np.float64)
+    frame_size = np.array([width, height, width, height], dtype=np.float64)
+    
+    batch_detections = []
+    for r in results:
+        detections = []
+        boxes = r.boxes
+        if boxes is not None and len(boxes):
+            # All boxes of the frame at once, in float64 like the Python floats they replace
+            boxes = boxes.cpu().numpy()
+            normalized = (boxes.xyxy.astype(np.float64) + offset) / frame_size
+            for (x_min, y_min, x_max, y_max), conf in zip(normalized.tolist(), boxes.conf.tolist()):
+                detections.append({
+                    'x_min': x_min,
+                    'y_min': y_min,
+                    'x_max': x_max,
+                    'y_max': y_max,
+                    'confidence': conf,
+                    'side': side
+                })
+        batch_detections.append(detections)
     
-    return True, avg_bbox
+    return batch_detections
 
 
 def process_tank_half_batch(model, frames: List[np.ndarray], tank_bbox: Dict, side: str, 
@@ -291,61 +394,58 @@ def process_tank_half_batch(model, frames: List[np.ndarray], tank_bbox: Dict, si
     
     height, width = frames[0].shape[:2]
     
-    # Calculate crop region
-    x_min = tank_bbox['x_min']
-    y_min = tank_bbox['y_min']
-    x_max = tank_bbox['x_max']
-    y_max = tank_bbox['y_max']
-    center_x = tank_bbox['center_x']
-    
-    if side == 'left':
-        crop_bbox = (x_min, y_min, center_x, y_max)
-    else:  # right
-        crop_bbox = (center_x, y_min, x_max, y_max)
-    
     # Crop all frames in batch
+    crop_bbox = half_crop_bbox(tank_bbox, side)
     crop_x_min, crop_y_min, crop_x_max, crop_y_max = crop_bbox
     cropped_frames = [frame[crop_y_min:crop_y_max, crop_x_min:crop_x_max] for frame in frames]
     
     # Run YOLO inference on batch
     results = model(cropped_frames, conf=conf_threshold, verbose=False)
     
-    # Convert detections to full-frame coordinates for each frame
-    batch_detections = []
-    for r in results:
-        detections = []
-        boxes = r.boxes
-        if boxes is not None:
-            for box in boxes:
-                # Get box coordinates in crop space
-                x1, y1, x2, y2 = box.xyxy[0].tolist()
-                conf = box.conf[0].item()
-                
-                # Convert to full-frame pixel coordinates
-                full_x1 = crop_x_min + x1
-                full_y1 = crop_y_min + y1
-                full_x2 = crop_x_min + x2
-                full_y2 = crop_y_min + y2
-                
-                # Normalize to 0-1 range
-                det = {
-                    'x_min': full_x1 / width,
-                    'y_min': full_y1 / height,
-                    'x_max': full_x2 / width,
-                    'y_max': full_y2 / height,
-                    'confidence': conf,
-                    'side': side
-                }
-                detections.append(det)
-        batch_detections.append(detections)
+    return results_to_detections(results, crop_bbox, width, height, side)
+
+
+def process_tank_halves_batch(model, frames: List[np.ndarray], tank_bbox: Dict,
+                              conf_threshold: float = 0.25) -> Tuple[List[List[Dict]], List[List[Dict]]]:
+    """
+    Process both halves of the tank in a single YOLO call for a batch of frames.
     
-    return batch_detections
+    Only for models that accept a dynamic batch size (see model_supports_batching).
+    
+    Returns:
+        Tuple of (left, right) detection lists, one per frame
+    """
+    if not frames:
+        return [], []
+    
+    height, width = frames[0].shape[:2]
+    left_bbox = half_crop_bbox(tank_bbox, 'left')
+    right_bbox = half_crop_bbox(tank_bbox, 'right')
+    
+    # Ultralytics only letterboxes to the minimal rectangle when every image in the call has
+    # the same shape, so trim the wider half at the centre line (one column when the tank
+    # width is odd) rather than let a square letterbox change the detections
+    half = min(left_bbox[2] - left_bbox[0], right_bbox[2] - right_bbox[0])
+    left_bbox = (left_bbox[0], left_bbox[1], left_bbox[0] + half, left_bbox[3])
+    right_bbox = (right_bbox[2] - half, right_bbox[1], right_bbox[2], right_bbox[3])
+    
+    # Left crops first, then right crops, so the results split at len(frames)
+    cropped_frames = [frame[left_bbox[1]:left_bbox[3], left_bbox[0]:left_bbox[2]] for frame in frames]
+    cropped_frames += [frame[right_bbox[1]:right_bbox[3], right_bbox[0]:right_bbox[2]] for frame in frames]
+    
+    results = model(cropped_frames, conf=conf_threshold, verbose=False)
+    
+    batch = len(frames)
+    return (results_to_detections(results[:batch], left_bbox, width, height, 'left'),
+            results_to_detections(results[batch:], right_bbox, width, height, 'right'))
 
 
 def process_batch_and_store_results(model, batch_frames: List[np.ndarray], batch_frame_numbers: List[int],
                                    tank_bbox: Dict, conf_threshold: float, keyframe_data: Dict,
                                    fps: float, start_time: float, total_frames: int, max_frames: int,
-                                   is_mirror: bool = False) -> Tuple[int, int]:
+                                   is_mirror: bool = False, combine_halves: bool = False,
+                                   progress=emit_progress, verbose: bool = True,
+                                   prior_left: int = 0, prior_right: int = 0) -> Tuple[int, int]:
     """
     Process a batch of frames and store the results in keyframe_data.
     
@@ -360,6 +460,12 @@ def process_batch_and_store_results(model, batch_frames: List[np.ndarray], batch
         start_time: Processing start time for progress reporting
         total_frames: Total frames in video
         max_frames: Maximum frames to process
+        is_mirror: Only detect on the right side
+        combine_halves: Run left and right crops through the model in one call
+        progress: Function that receives progress updates (default: emit_progress)
+        verbose: Print a line per processed frame
+        prior_left: Left detections stored before this batch, for progress totals
+        prior_right: Right detections stored before this batch, for progress totals
     
     Returns:
         Tuple of (left_detections_count, right_detections_count) for this batch
@@ -369,6 +475,11 @@ def process_batch_and_store_results(model, batch_frames: List[np.ndarray], batch
         # Mirror mode: only process right side, left is empty
         left_batch_detections = [[] for _ in batch_frame_numbers]
         right_batch_detections = process_tank_half_batch(model, batch_frames, tank_bbox, 'right', conf_threshold)
+    elif combine_halves:
+        # Normal mode, one forward pass over both tank halves
+        left_batch_detections, right_batch_detections = process_tank_halves_batch(
+            model, batch_frames, tank_bbox, conf_threshold
+        )
     else:
         # Normal mode: process both tank halves
         left_batch_detections = process_tank_half_batch(model, batch_frames, tank_bbox, 'left', conf_threshold)
@@ -396,15 +507,16 @@ def process_batch_and_store_results(model, batch_frames: List[np.ndarray], batch
         # Report progress
         left_status = f"{len(left_dets)} octopus" if left_dets else "No octopus"
         right_status = f"{len(right_dets)} octopus" if right_dets else "No octopus"
-        print(f"Frame {frame_num} (t={frame_num/fps:.2f}s): Left: {left_status}, Right: {right_status}")
+        if verbose:
+            print(f"Frame {frame_num} (t={frame_num/fps:.2f}s): Left: {left_status}, Right: {right_status}")
         
         # Emit progress every 30 frames (approximately every second at 30fps)
         if frame_num % 1 == 0:
-            # Get current total detections from keyframe_data
-            current_left_total = sum(len(kf['left_detections']) for kf in keyframe_data['keyframes'].values())
-            current_right_total = sum(len(kf['right_detections']) for kf in keyframe_data['keyframes'].values())
+            # Running totals, rather than re-counting every stored keyframe on each frame
+            current_left_total = prior_left + total_left
+            current_right_total = prior_right + total_right
             
-            emit_progress({
+            progress({
                 'type': 'progress',
                 'stage': 'frame_processing',
                 'current_frame': frame_num,
@@ -419,13 +531,54 @@ def process_batch_and_store_results(model, batch_frames: List[np.ndarray], batch
     return total_left, total_right
 
 
+def read_keyframe_batches(cap, frame_interval: int, total_frames: int, max_frames: int,
+                          batch_size: int, batch_queue: queue.Queue, stop_event: threading.Event):
+    """Decode keyframes into (frame_numbers, frames) batches on batch_queue, ending with (None, frames_read or error)"""
+    frame_count = 0
+    batch_frames = []
+    batch_frame_numbers = []
+    
+    try:
+        while frame_count < max_frames and not stop_event.is_set():
+            # grab() only advances the stream; just the keyframes are converted to BGR
+            if not cap.grab():
+                break
+            
+            # Check if this is a keyframe
+            if frame_count % frame_interval == 0 or frame_count == max_frames - 1 or frame_count == total_frames - 1:
+                ret, frame = cap.retrieve()
+                if not ret:
+                    break
+                
+                batch_frames.append(frame)
+                batch_frame_numbers.append(frame_count)
+                
+                # Hand off the batch when full or at end of video
+                if len(batch_frames) == batch_size or frame_count + frame_interval >= max_frames:
+                    batch_queue.put((batch_frame_numbers, batch_frames))
+                    batch_frames = []
+                    batch_frame_numbers = []
+            
+            frame_count += 1
+        
+        # Hand off any remaining frames
+        if batch_frames:
+            batch_queue.put((batch_frame_numbers, batch_frames))
+    except Exception as e:
+        batch_queue.put((None, e))
+        return
+    
+    batch_queue.put((None, frame_count))
+
+
 def detect_octopus_in_video(video_path: str, model_path: str, tank_bbox: Dict = None,
                             duration: float = 60, hertz: float = 2,
                             conf_threshold: float = 0.25, device: str = None,
                             moondream_device: str = None, scale: float = 0.5,
                             batch_size: int = 4, preprocess: bool = True,
                             is_mirror: bool = False, is_social: bool = False, 
-                            is_control: bool = False) -> Dict:
+                            is_control: bool = False, progress_callback=None,
+                            cancel_event: threading.Event = None, verbose: bool = True) -> Dict:
     """
     Run YOLO detection on video, processing tank halves separately with batch processing.
     
@@ -439,176 +592,196 @@ def detect_octopus_in_video(video_path: str, model_path: str, tank_bbox: Dict =
         device: Device to use for YOLO
         moondream_device: Device to use for moondream tank detection
         scale: Scale factor for moondream processing
-        batch_size: Number of frames to process in parallel (default: 4)
+        batch_size: Number of frames to process in parallel, 1 for static exports (default: 4)
         preprocess: Whether to preprocess keyframes to remove extra detections (default: True)
         is_mirror: Mirror mode - only detect on right side (default: False)
         is_social: Social experiment mode (cosmetic flag, default: False)
         is_control: Control experiment mode (cosmetic flag, default: False)
+        progress_callback: Function that receives progress dicts (default: PROGRESS lines on stdout)
+        cancel_event: threading.Event that stops detection with DetectionCancelled
+        verbose: Print a line per processed frame (default: True)
     
     Returns:
         Dictionary with keyframe detections
     """
-    # Detect tank if not provided
-    if tank_bbox is None:
-        # Auto-detect device if not specified
-        if moondream_device is None:
-            moondream_device = get_best_available_device()
-            print(f"Auto-detected moondream device: {moondream_device}")
-        
-        print("Loading moondream model for tank detection...")
-        emit_progress({
-            'type': 'progress',
-            'stage': 'tank_detection',
-            'message': 'Loading moondream model for tank detection... (can take 10+ minutes if first time)',
-        })
-        # Dont do this in production! This only works cause moondream is a **free** API with no consequences/billing rn - CHANGE TO PROPER AUTH EVENTUALLY or BETTER: get your **own** API key
-        def rot13(text):
-            result = []
-            for char in text:
-                if 'a' <= char <= 'z':
-                    result.append(chr((ord(char) - ord('a') + 13) % 26 + ord('a')))
-                elif 'A' <= char <= 'Z':
-                    result.append(chr((ord(char) - ord('A') + 13) % 26 + ord('A')))
-                else:
-                    result.append(char)
-            return ''.join(result)
-        moondream_model = md.vl(api_key=rot13("rlWuoTpvBvWVHmV1AvVfVaE5pPV6VxcKIPW9.rlWeMKysnJDvBvWzZzZmBGWyAF05AzD0YGD3ZJRgLzLlZv01LwRlMzZjZmAuMTRvYPWipzqsnJDvBvW1IwuxJaI6ITWUJJgxHwA0HT1In0H5Z25ZAQExZJ1fpFVfVzyuqPV6ZGp1Zmp1ZQZjAvjvqzIlVwbksD.Me1nHvLp6AJZZizSFou_tOThRWaOvOCaFrT6fidjP6R"))
-        found, bbox_tuple = find_tank_bbox(video_path, moondream_model, scale=scale)
-        if not found:
-            raise ValueError("Could not find tank in video")
-        
-        x_min, y_min, x_max, y_max = bbox_tuple
-        tank_bbox = {
-            'x_min': x_min,
-            'y_min': y_min,
-            'x_max': x_max,
-            'y_max': y_max,
-            'center_x': x_min if is_mirror else (x_min + x_max) // 2
-        }
-        
-        # Clean up moondream model
-        del moondream_model
-        torch.cuda.empty_cache() if torch.cuda.is_available() else None
-    # Auto-detect device if not specified
-    if device is None:
-        if torch.cuda.is_available():
-            device = 'cuda'
-        elif torch.backends.mps.is_available():
-            device = 'mps'
-        else:
-            device = 'cpu'
-    
+    progress = progress_callback or emit_progress
     
-    print(f"Running inference on device: {device}")
-    
-    # Load model
-    model = YOLO(model_path)
-
-    
-    # Open video
+    # Open video once for both the tank search and detection
     cap = cv2.VideoCapture(video_path)
     if not cap.isOpened():
         raise ValueError(f"Could not open video: {video_path}")
     
-    fps = cap.get(cv2.CAP_PROP_FPS)
-    frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    
-    # Calculate frame interval
-    frame_interval = int(fps / hertz)
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    print(total_frames)
-    max_frames = int(fps * duration)
-    
-    print(f"Video FPS: {fps}")
-    print(f"Processing every {frame_interval} frames ({hertz} Hz)")
-    
-    # Prepare output data
-    keyframe_data = {
-        'video_info': {
-            'filename': video_path,
-            'fps': fps,
-            'width': frame_width,
-            'height': frame_height,
-            'duration_processed': 0,
-            'total_frames_processed': 0
-        },
-        'tank_info': {
-            'bbox': tank_bbox
-        },
-        'detection_params': {
-            'object': 'octopus',
-            'hertz': hertz,
-            'max_duration': duration,
-            'model': model_path,
-            'confidence_threshold': conf_threshold,
-            'batch_size': batch_size,
-            'is_mirror': is_mirror,
-            'is_social': is_social,
-            'is_control': is_control
-        },
-        'keyframes': {}
-    }
-    
-    frame_count = 0
-    total_left_detections = 0
-    total_right_detections = 0
-    start_time = time.time()
-    
-    # Batch processing variables
-    batch_frames = []
-    batch_frame_numbers = []
-    
-    print(f"\nProcessing video with batch size: {batch_size}...")
-    if is_mirror:
-        print("Mirror mode enabled - only detecting on right side")
-    emit_progress({
-        'type': 'progress',
-        'stage': 'frame_processing',
-        'message': f'Processing video with batch size: {batch_size}...',
-        'total_frames': min(max_frames, total_frames),
-        'fps': fps
-    })
-    
-    while frame_count < max_frames:
-        ret, frame = cap.read()
-        if not ret:
-            break
-        
-        # Check if this is a keyframe
-        if frame_count % frame_interval == 0 or frame_count == max_frames - 1 or frame_count == total_frames - 1:
-            batch_frames.append(frame)
-            batch_frame_numbers.append(frame_count)
+    model = None
+    try:
+        # Detect tank if not provided
+        if tank_bbox is None:
+            # Auto-detect device if not specified
+            if moondream_device is None:
+                moondream_device = get_best_available_device()
+                print(f"Auto-detected moondream device: {moondream_device}")
+            
+            print("Loading moondream model for tank detection...")
+            progress({
+                'type': 'progress',
+                'stage': 'tank_detection',
+                'message': 'Loading moondream model for tank detection... (can take 10+ minutes if first time)',
+            })
+            # Dont do this in production! This only works cause moondream is a **free** API with no consequences/billing rn - CHANGE TO PROPER AUTH EVENTUALLY or BETTER: get your **own** API key
+            def rot13(text):
+                result = []
+                for char in text:
+                    if 'a' <= char <= 'z':
+                        result.append(chr((ord(char) - ord('a') + 13) % 26 + ord('a')))
+                    elif 'A' <= char <= 'Z':
+                        result.append(chr((ord(char) - ord('A') + 13) % 26 + ord('A')))
+                    else:
+                        result.append(char)
+                return ''.join(result)
+            moondream_model = md.vl(api_key=rot13("rlWuoTpvBvWVHmV1AvVfVaE5pPV6VxcKIPW9.rlWeMKysnJDvBvWzZzZmBGWyAF05AzD0YGD3ZJRgLzLlZv01LwRlMzZjZmAuMTRvYPWipzqsnJDvBvW1IwuxJaI6ITWUJJgxHwA0HT1In0H5Z25ZAQExZJ1fpFVfVzyuqPV6ZGp1Zmp1ZQZjAvjvqzIlVwbksD.Me1nHvLp6AJZZizSFou_tOThRWaOvOCaFrT6fidjP6R"))
+            found, bbox_tuple = find_tank_bbox(cap, moondream_model, scale=scale,
+                                               progress=progress, cancel_event=cancel_event)
+            if not found:
+                raise ValueError("Could not find tank in video")
+            
+            # The search seeks around the middle of the video; detection reads from the start
+            cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            
+            x_min, y_min, x_max, y_max = bbox_tuple
+            tank_bbox = {
+                'x_min': x_min,
+                'y_min': y_min,
+                'x_max': x_max,
+                'y_max': y_max,
+                'center_x': x_min if is_mirror else (x_min + x_max) // 2
+            }
             
-            # Process batch when full or at end of video
-            if len(batch_frames) == batch_size or frame_count + frame_interval >= max_frames:
+            # Clean up moondream model
+            del moondream_model
+            torch.cuda.empty_cache() if torch.cuda.is_available() else None
+        # Auto-detect device if not specified
+        if device is None:
+            if torch.cuda.is_available():
+                device = 'cuda'
+            elif torch.backends.mps.is_available():
+                device = 'mps'
+            else:
+                device = 'cpu'
+        
+        
+        print(f"Running inference on device: {device}")
+        
+        # Load model, reusing one a previous job in this process left behind
+        model = _idle_models.pop(model_path, None) or YOLO(model_path)
+        # Static exports (the bundled ones are) take one image per call, so they run at batch
+        # size 1 with the halves in separate calls; batch_size is an upper bound
+        combine_halves = model_supports_batching(model_path)
+        if not combine_halves:
+            batch_size = 1
+
+        
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        
+        # Calculate frame interval
+        frame_interval = int(fps / hertz)
+        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        print(total_frames)
+        max_frames = int(fps * duration)
+        
+        print(f"Video FPS: {fps}")
+        print(f"Processing every {frame_interval} frames ({hertz} Hz)")
+        
+        # Prepare output data
+        keyframe_data = {
+            'video_info': {
+                'filename': video_path,
+                'fps': fps,
+                'width': frame_width,
+                'height': frame_height,
+                'duration_processed': 0,
+                'total_frames_processed': 0
+            },
+            'tank_info': {
+                'bbox': tank_bbox
+            },
+            'detection_params': {
+                'object': 'octopus',
+                'hertz': hertz,
+                'max_duration': duration,
+                'model': model_path,
+                'confidence_threshold': conf_threshold,
+                'batch_size': batch_size,
+                'is_mirror': is_mirror,
+                'is_social': is_social,
+                'is_control': is_control
+            },
+            'keyframes': {}
+        }
+        
+        total_left_detections = 0
+        total_right_detections = 0
+        start_time = time.time()
+        
+        print(f"\nProcessing video with batch size: {batch_size}...")
+        if is_mirror:
+            print("Mirror mode enabled - only detecting on right side")
+        progress({
+            'type': 'progress',
+            'stage': 'frame_processing',
+            'message': f'Processing video with batch size: {batch_size}...',
+            'total_frames': min(max_frames, total_frames),
+            'fps': fps
+        })
+        
+        # Decode on a background thread so the next batch is ready while YOLO runs;
+        # OpenCV releases the GIL while decoding
+        batch_queue = queue.Queue(maxsize=PREFETCH_BATCHES)
+        stop_reading = threading.Event()
+        reader = threading.Thread(
+            target=read_keyframe_batches,
+            args=(cap, frame_interval, total_frames, max_frames, batch_size, batch_queue, stop_reading),
+            daemon=True
+        )
+        reader.start()
+        
+        try:
+            while True:
+                batch_frame_numbers, batch_frames = batch_queue.get()
+                if batch_frame_numbers is None:
+                    # The reader is done and hands back its frame count, or the error that stopped it
+                    if isinstance(batch_frames, Exception):
+                        raise batch_frames
+                    frame_count = batch_frames
+                    break
+                
+                if cancel_event is not None and cancel_event.is_set():
+                    raise DetectionCancelled()
+                
                 # Process the batch and store results
                 batch_left, batch_right = process_batch_and_store_results(
                     model, batch_frames, batch_frame_numbers, tank_bbox, conf_threshold,
-                    keyframe_data, fps, start_time, total_frames, max_frames, is_mirror
+                    keyframe_data, fps, start_time, total_frames, max_frames, is_mirror,
+                    combine_halves, progress, verbose,
+                    total_left_detections, total_right_detections
                 )
                 
                 # Update totals
                 total_left_detections += batch_left
                 total_right_detections += batch_right
-                
-                # Clear batch
-                batch_frames = []
-                batch_frame_numbers = []
-        
-        frame_count += 1
-    
-    # Process any remaining frames in the batch
-    if batch_frames:
-        # Process the batch and store results
-        batch_left, batch_right = process_batch_and_store_results(
-            model, batch_frames, batch_frame_numbers, tank_bbox, conf_threshold,
-            keyframe_data, fps, start_time, total_frames, max_frames, is_mirror
-        )
-        
-        # Update totals
-        total_left_detections += batch_left
-        total_right_detections += batch_right
+        finally:
+            # Stop the reader, draining so it is not left blocked on a full queue
+            stop_reading.set()
+            while reader.is_alive():
+                try:
+                    batch_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+    finally:
+        cap.release()
+        # Hand the model back for the next job, also when this one failed or was cancelled
+        if model is not None:
+            _idle_models[model_path] = model
     
     # Update final statistics
     end_time = time.time()
@@ -625,8 +798,6 @@ def detect_octopus_in_video(video_path: str, model_path: str, tank_bbox: Dict =
         'total_right_detections': total_right_detections
     }
     
-    cap.release()
-    
     print(f"\nProcessing completed:")
     print(f"  Video duration: {video_duration:.2f}s")
     print(f"  Processing time: {processing_time:.2f}s")
@@ -641,7 +812,7 @@ def detect_octopus_in_video(video_path: str, model_path: str, tank_bbox: Dict =
         print("Preprocessing completed.")
     
     # Emit completion progress
-    emit_progress({
+    progress({
         'type': 'complete',
         'message': 'Detection completed successfully',
         'total_keyframes': len(keyframe_data['keyframes']),
@@ -653,6 +824,21 @@ def detect_octopus_in_video(video_path: str, model_path: str, tank_bbox: Dict =
     return keyframe_data
 
 
+def paths_for_code(code: str) -> Tuple[str, str]:
+    """Return the (video, keyframes output) paths for a 4-digit video code"""
+    return f"videos/MVI_{code}_proxy.mp4", f"videos_keyframes/MVI_{code}_keyframes.json"
+
+
+def save_keyframes(keyframe_data: Dict, output_path: str, pretty: bool = False):
+    """Write keyframe data as JSON, through a temp file that is swapped in"""
+    # Readers never see a partial file, and the directory mtime changes for the server's media index
+    tmp_path = f"{output_path}.tmp"
+    option = orjson.OPT_SERIALIZE_NUMPY | (orjson.OPT_INDENT_2 if pretty else 0)
+    with open(tmp_path, 'wb') as f:
+        f.write(orjson.dumps(keyframe_data, option=option))
+    os.replace(tmp_path, output_path)
+
+
 def main():
     parser = argparse.ArgumentParser(description='Run YOLO octopus detection on video')
     parser.add_argument('video', type=str, help='Path to input video file')
@@ -676,7 +862,7 @@ def main():
     parser.add_argument('--scale', type=float, default=0.5,
                         help='Scale factor for moondream processing (default: 0.5)')
     parser.add_argument('--batch-size', type=int, default=1,
-                        help='Number of frames to process in parallel (default: 4)')
+                        help='Number of frames to process in parallel, .pt and dynamic exports only (default: 1)')
     parser.add_argument('--no-preprocess', action='store_true',
                         help='Disable preprocessing of keyframes to remove extra detections')
     parser.add_argument('--progress-json', action='store_true',
@@ -687,6 +873,8 @@ def main():
                         help='Social experiment mode (cosmetic flag for categorization)')
     parser.add_argument('--control', action='store_true',
                         help='Control experiment mode (cosmetic flag for categorization)')
+    parser.add_argument('--pretty', action='store_true',
+                        help='Indent the output JSON for reading by hand (default: compact)')
     
     args = parser.parse_args()
     
@@ -722,9 +910,8 @@ def main():
     # Check if video is 4-digit number
     video_path = args.video
     if args.video.isdigit() and len(args.video) == 4:
-        video_path = f"videos/MVI_{args.video}_proxy.mp4"
+        video_path, args.output = paths_for_code(args.video)
         print(f"Interpreting video as code, using path: {video_path}")
-        args.output = f"videos_keyframes/MVI_{args.video}_keyframes.json"
         args.video = video_path
 
     # Auto-detect model format if not specified
@@ -757,8 +944,7 @@ def main():
         output_path = f"{video_stem}_yolo_keyframes.json"
     
     # Save results
-    with open(output_path, 'w') as f:
-        json.dump(keyframe_data, f, indent=2)
+    save_keyframes(keyframe_data, output_path, pretty=args.pretty)
     
     print(f"\nResults saved to: {output_path}")
 
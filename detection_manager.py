@@ -1,10 +1,6 @@
 #!/usr/bin/env python3
-import subprocess
 import threading
-import json
-import os
 import time
-from pathlib import Path
 import queue
 import uuid
 
@@ -12,6 +8,8 @@ class DetectionManager:
     def __init__(self):
         self.jobs = {}  # job_id: job_info
         self.progress_queues = {}  # job_id: queue for SSE
+        # Guards job status changes, so a cancel and a finishing job can't both win
+        self.lock = threading.Lock()
         
     def start_detection(self, code, params=None):
         """Start a new detection job"""
@@ -22,7 +20,7 @@ class DetectionManager:
             'hertz': 2,
             'confidence': 0.75,
             'duration': 3600 * 10, # Max duration of 10 hours
-            'batch_size': 1
+            'batch_size': 16 # Upper bound; static-batch exports run at 1 in detect_with_yolo.py
         }
         # Merge user params with defaults
         params = {**default_params, **(params or {})}
@@ -30,92 +28,90 @@ class DetectionManager:
         # Create progress queue
         self.progress_queues[job_id] = queue.Queue()
         
-        # Start detection in thread
         thread = threading.Thread(
             target=self._run_detection,
             args=(job_id, code, params)
         )
         thread.daemon = True
-        thread.start()
         
-        # Store job info
+        # Store job info before the thread starts, since it reads its cancel event from here
         self.jobs[job_id] = {
             'id': job_id,
             'code': code,
             'status': 'running',
             'thread': thread,
+            'cancel_event': threading.Event(),
             'start_time': time.time(),
             'params': params
         }
         
+        # Start detection in thread
+        thread.start()
+        
         return job_id
     
     def _run_detection(self, job_id, code, params):
-        """Run detection subprocess and capture output"""
+        """Run detection in this thread and forward its progress"""
+        job = self.jobs[job_id]
+        progress_queue = self.progress_queues[job_id]
+        
+        def report(data):
+            # The keyframes file is only written once detection returns, so the
+            # completion update is sent after saving instead
+            if data.get('type') != 'complete':
+                progress_queue.put(data)
+        
         try:
-            cmd = [
-                'python', 'detect_with_yolo.py',
-                code,  # Will be interpreted as 4-digit code
-                '--hertz', str(params['hertz']),
-                '--confidence', str(params['confidence']),
-                '--duration', str(params['duration']),
-                '--batch-size', str(params['batch_size']),
-                '--progress-json'  # New flag for JSON progress output
-            ]
+            # Loaded on first use; torch, ultralytics and moondream take seconds to import,
+            # and later jobs reuse both the modules and the loaded YOLO model
+            import detect_with_yolo
             
-            # Add experiment type flags if specified
-            if params.get('is_mirror'):
-                cmd.append('--mirror')
-            elif params.get('is_social'):
-                cmd.append('--social')
-            elif params.get('is_control'):
-                cmd.append('--control')
-            
-            process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-                bufsize=1,
-                universal_newlines=True
-            )
+            video_path, output_path = detect_with_yolo.paths_for_code(code)
             
-            self.jobs[job_id]['process'] = process
+            # Experiment type flags are exclusive, mirror first
+            is_mirror = bool(params.get('is_mirror'))
+            is_social = not is_mirror and bool(params.get('is_social'))
+            is_control = not is_mirror and not is_social and bool(params.get('is_control'))
             
-            # Read output line by line
-            for line in process.stdout:
-                line = line.strip()
-                if line.startswith('PROGRESS:'):
-                    # Parse JSON progress update
-                    try:
-                        progress_data = json.loads(line[9:])
-                        self.progress_queues[job_id].put(progress_data)
-                    except json.JSONDecodeError:
-                        pass
-            
-            # Wait for process to complete
-            process.wait()
+            keyframe_data = detect_with_yolo.detect_octopus_in_video(
+                video_path,
+                detect_with_yolo.get_best_model_format(),
+                duration=float(params['duration']),
+                hertz=float(params['hertz']),
+                conf_threshold=float(params['confidence']),
+                batch_size=int(params['batch_size']),
+                is_mirror=is_mirror,
+                is_social=is_social,
+                is_control=is_control,
+                progress_callback=report,
+                cancel_event=job['cancel_event'],
+                verbose=False
+            )
             
-            # Update job status
-            if process.returncode == 0:
-                self.jobs[job_id]['status'] = 'completed'
-                self.progress_queues[job_id].put({
+            # Held while saving, so a cancel either lands first and the existing keyframes
+            # are left alone, or waits and finds the job already completed
+            with self.lock:
+                if job['cancel_event'].is_set():
+                    return
+                
+                detect_with_yolo.save_keyframes(keyframe_data, output_path)
+                
+                job['status'] = 'completed'
+                progress_queue.put({
                     'type': 'complete',
                     'message': 'Detection completed successfully'
                 })
-            else:
-                self.jobs[job_id]['status'] = 'failed'
-                self.progress_queues[job_id].put({
+        except Exception as e:
+            with self.lock:
+                # cancel_job already reported the cancellation on the progress queue
+                if job['status'] == 'cancelled':
+                    return
+                
+                job['status'] = 'failed'
+                progress_queue.put({
                     'type': 'error',
-                    'message': f'Detection failed with code {process.returncode}'
+                    'message': str(e)
                 })
-                
-        except Exception as e:
-            self.jobs[job_id]['status'] = 'failed'
-            self.progress_queues[job_id].put({
-                'type': 'error',
-                'message': str(e)
-            })
     
     def get_progress_queue(self, job_id):
         """Get progress queue for a job"""
@@ -125,10 +121,17 @@ class DetectionManager:
         """Cancel a running job"""
         if job_id in self.jobs:
             job = self.jobs[job_id]
-            if 'process' in job and job['process'].poll() is None:
-                job['process'].terminate()
-                job['status'] = 'cancelled'
-                return True
+            with self.lock:
+                if job['status'] == 'running':
+                    job['status'] = 'cancelled'
+                    # Detection stops at its next sampled frame or batch
+                    job['cancel_event'].set()
+                    # Wake any SSE stream waiting on this job
+                    self.progress_queues[job_id].put({
+                        'type': 'cancelled',
+                        'message': 'Detection cancelled'
+                    })
+                    return True
         return False
     
     def get_job_status(self, job_id):
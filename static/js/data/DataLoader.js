@@ -41,13 +41,15 @@ export class DataLoader {
         this.isLoading = true;
         this.eventBus.emit(Events.UI_MODAL_SHOW, { type: 'loading' });
 
-        const formData = new FormData();
-        formData.append('video', videoFile);
-
         try {
+            // Send the raw file as the request body so the server can stream it to disk
             const response = await fetch('/upload-video', {
                 method: 'POST',
-                body: formData
+                headers: {
+                    'Content-Type': 'application/octet-stream',
+                    'X-Filename': encodeURIComponent(videoFile.name)
+                },
+                body: videoFile
             });
 
             const contentType = response.headers.get('content-type');